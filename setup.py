@@ -22,6 +22,9 @@ setup(
         'jsonpath-ng>=1.5.3'
         'pyarrow>=5.0.0'
     ],
+    extras_require={
+        'orjson': ['orjson'],
+    },
     packages=["tap_spreadsheets_anywhere"],
     include_package_data=True,
     tests_require=[
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 import dateutil
-import singer
 from singer import utils
 from singer.catalog import Catalog, CatalogEntry
 from singer.schema import Schema
@@ -11,6 +12,9 @@ from singer.schema import Schema
 from tap_spreadsheets_anywhere.configuration import Config
 import tap_spreadsheets_anywhere.conversion as conversion
 import tap_spreadsheets_anywhere.file_utils as file_utils
+import tap_spreadsheets_anywhere.listing_cache as listing_cache
+import tap_spreadsheets_anywhere.output as output
+import tap_spreadsheets_anywhere.schema_cache as schema_cache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -41,14 +45,20 @@ def override_schema_with_config(inferred_schema, table_spec):
 
 
 def generate_schema(table_spec, samples):
+    return generate_schema_from_counts(table_spec, conversion.count_samples(samples))
+
+
+def generate_schema_from_counts(table_spec, counts):
     metadata_schema = {
         '_smart_source_bucket': {'type': 'string'},
         '_smart_source_file': {'type': 'string'},
         '_smart_source_lineno': {'type': 'integer'},
     }
+    if 'worksheet_names' in table_spec:
+        metadata_schema['_smart_source_worksheet'] = {'type': 'string'}
     prefer_number_vs_integer = table_spec.get('prefer_number_vs_integer', False)
     prefer_schema_as_string = table_spec.get('prefer_schema_as_string', False)
-    data_schema = conversion.generate_schema(samples, prefer_number_vs_integer=prefer_number_vs_integer, prefer_schema_as_string=prefer_schema_as_string)
+    data_schema = conversion.generate_schema_from_counts(counts, prefer_number_vs_integer=prefer_number_vs_integer, prefer_schema_as_string=prefer_schema_as_string)
     inferred_schema = {
         'type': 'object',
         'properties': merge_dicts(data_schema, metadata_schema)
@@ -58,73 +68,120 @@ def generate_schema(table_spec, samples):
     return Schema.from_dict(merged_schema)
 
 def discover(config):
-    streams = []
-    for table_spec in config['tables']:
-        try:
-            modified_since = dateutil.parser.parse(table_spec['start_date'])
-            target_files = file_utils.get_matching_objects(table_spec, modified_since)
-            sample_rate = table_spec.get('sample_rate',5)
-            max_sampling_read = table_spec.get('max_sampling_read', 1000)
-            max_sampled_files = table_spec.get('max_sampled_files', 50)
-            samples = file_utils.sample_files(table_spec, target_files,sample_rate=sample_rate,
-                                              max_records=max_sampling_read, max_files=max_sampled_files)
-            schema = generate_schema(table_spec, samples)
-            stream_metadata = []
-            key_properties = table_spec.get('key_properties', [])
-            streams.append(
-                CatalogEntry(
-                    tap_stream_id=table_spec['name'],
-                    stream=table_spec['name'],
-                    schema=schema,
-                    key_properties=key_properties,
-                    metadata=stream_metadata,
-                    replication_key=None,
-                    is_view=None,
-                    database=None,
-                    table=None,
-                    row_count=None,
-                    stream_alias=None,
-                    replication_method=None,
-                )
-            )
-        except Exception as err:
-            LOGGER.error(f"Unable to write Catalog entry for '{table_spec['name']}' - it will be skipped due to error {err}")
-            raise err
+    schema_cache.configure(config)
+    max_parallel_discovery = config.get('max_parallel_discovery', 1)
+    if max_parallel_discovery > 1:
+        # Tables are discovered on one pool and their files sampled on another, so that table workers
+        # waiting for their samples never hold up the file workers
+        with ThreadPoolExecutor(max_workers=max_parallel_discovery, thread_name_prefix='discover') as table_executor, \
+                ThreadPoolExecutor(max_workers=max_parallel_discovery, thread_name_prefix='sample') as file_executor:
+            streams = list(table_executor.map(lambda table_spec: discover_stream(table_spec, file_executor),
+                                              config['tables']))
+    else:
+        streams = [discover_stream(table_spec) for table_spec in config['tables']]
 
     return Catalog(streams)
 
 
-def sync(config, state, catalog):
-    # Loop over selected streams in catalog
-    LOGGER.info(f"Processing {len(list(catalog.get_selected_streams(state)))} selected streams from Catalog")
-    for stream in catalog.get_selected_streams(state):
-        LOGGER.info("Syncing stream:" + stream.tap_stream_id)
-        catalog_schema = stream.schema.to_dict()
-        table_spec = next((x for x in config['tables'] if x['name'] == stream.tap_stream_id), None)
-        if table_spec is not None:
-            # Allow updates to our tables specification to override any previously extracted schema in the catalog
-            merged_schema = override_schema_with_config(catalog_schema, table_spec)
-            singer.write_schema(
-                stream_name=stream.tap_stream_id,
-                schema=merged_schema,
-                key_properties=stream.key_properties,
-            )
-            modified_since = dateutil.parser.parse(
-                state.get(stream.tap_stream_id, {}).get('modified_since') or table_spec['start_date'])
-            target_files = file_utils.get_matching_objects(table_spec, modified_since)
-            max_records_per_run = table_spec.get('max_records_per_run', -1)
-            records_streamed = 0
-            for t_file in target_files:
-                records_streamed += file_utils.write_file(t_file['key'], table_spec, merged_schema, max_records=max_records_per_run-records_streamed)
+def discover_stream(table_spec, executor=None):
+    try:
+        modified_since = dateutil.parser.parse(table_spec['start_date'])
+        sample_rate = table_spec.get('sample_rate',5)
+        max_sampling_read = table_spec.get('max_sampling_read', 1000)
+        max_sampled_files = table_spec.get('max_sampled_files', 50)
+        # Only the oldest files are sampled, so only those are kept while listing. At least one file is
+        # always sampled, as count_files_samples does.
+        target_files = file_utils.iter_matching_objects(table_spec, modified_since, limit=max(max_sampled_files, 1))
+        counts = file_utils.count_files_samples(table_spec, target_files, sample_rate=sample_rate,
+                                                max_records=max_sampling_read, max_files=max_sampled_files,
+                                                executor=executor)
+        schema = generate_schema_from_counts(table_spec, counts)
+        stream_metadata = []
+        key_properties = table_spec.get('key_properties', [])
+        return CatalogEntry(
+            tap_stream_id=table_spec['name'],
+            stream=table_spec['name'],
+            schema=schema,
+            key_properties=key_properties,
+            metadata=stream_metadata,
+            replication_key=None,
+            is_view=None,
+            database=None,
+            table=None,
+            row_count=None,
+            stream_alias=None,
+            replication_method=None,
+        )
+    except Exception as err:
+        LOGGER.error(f"Unable to write Catalog entry for '{table_spec['name']}' - it will be skipped due to error {err}")
+        raise err
+
+
+def sync_stream(config, state, stream):
+    LOGGER.info("Syncing stream:" + stream.tap_stream_id)
+    catalog_schema = stream.schema.to_dict()
+    table_spec = next((x for x in config['tables'] if x['name'] == stream.tap_stream_id), None)
+    if table_spec is not None:
+        # Allow updates to our tables specification to override any previously extracted schema in the catalog
+        merged_schema = override_schema_with_config(catalog_schema, table_spec)
+        output.write_schema(
+            stream_name=stream.tap_stream_id,
+            schema=merged_schema,
+            key_properties=stream.key_properties,
+        )
+        bookmark = state.get(stream.tap_stream_id, {})
+        modified_since = dateutil.parser.parse(bookmark.get('modified_since') or table_spec['start_date'])
+        target_files = file_utils.iter_matching_objects(table_spec, modified_since, etag=bookmark.get('etag'))
+        max_records_per_run = table_spec.get('max_records_per_run', -1)
+        converter = conversion.compile_row_converter(merged_schema)
+        max_parallel_files = table_spec.get('max_parallel_files', 1)
+        if max_parallel_files > 1:
+            files = file_utils.prefetch_files(target_files, table_spec, merged_schema, max_parallel_files,
+                                              converter=converter)
+        else:
+            files = ((t_file, None) for t_file in target_files)
+        records_streamed = 0
+        with closing(files):
+            for t_file, records in files:
+                records_streamed += file_utils.write_file(t_file['key'], table_spec, merged_schema,
+                                                          max_records=max_records_per_run-records_streamed,
+                                                          converter=converter, records=records)
                 if 0 < max_records_per_run <= records_streamed:
                     LOGGER.info(f'Processed the per-run limit of {records_streamed} records for stream "{stream.tap_stream_id}". Stopping sync for this stream.')
                     break
-                state[stream.tap_stream_id] = {'modified_since': t_file['last_modified'].isoformat()}
-                singer.write_state(state)
+                bookmark = {'modified_since': t_file['last_modified'].isoformat()}
+                if 'etag' in t_file:
+                    # Lets HTTP sources answer the next run with 304 Not Modified
+                    bookmark['etag'] = t_file['etag']
+                output.write_bookmark(state, stream.tap_stream_id, bookmark)
 
-            LOGGER.info(f'Wrote {records_streamed} records for stream "{stream.tap_stream_id}".')
+        LOGGER.info(f'Wrote {records_streamed} records for stream "{stream.tap_stream_id}".')
+    else:
+        LOGGER.warn(f'Skipping processing for stream [{stream.tap_stream_id}] without a config block.')
+
+
+def sync(config, state, catalog):
+    # Loop over selected streams in catalog
+    streams = list(catalog.get_selected_streams(state))
+    LOGGER.info(f"Processing {len(streams)} selected streams from Catalog")
+    max_parallel_streams = config.get('max_parallel_streams', 1)
+    output.configure(config)
+    try:
+        if max_parallel_streams > 1:
+            with ThreadPoolExecutor(max_workers=max_parallel_streams, thread_name_prefix='stream') as executor:
+                futures = [executor.submit(sync_stream, config, state, stream) for stream in streams]
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
         else:
-            LOGGER.warn(f'Skipping processing for stream [{stream.tap_stream_id}] without a config block.')
+            for stream in streams:
+                sync_stream(config, state, stream)
+    finally:
+        output.flush()
     return
 
 REQUIRED_CONFIG_KEYS = 'tables'
@@ -133,6 +190,8 @@ REQUIRED_CONFIG_KEYS = 'tables'
 def main():
     # Parse command line arguments
     args = utils.parse_args([REQUIRED_CONFIG_KEYS])
+    # Share object listings between discovery and sync, and across runs when a listing cache directory is set
+    listing_cache.configure(args.config)
     crawl_paths = [x for x in args.config['tables'] if "crawl_config" in x and x["crawl_config"]]
     if len(crawl_paths) > 0: # Our config includes at least one crawl block
         LOGGER.info("Executing experimental 'crawl' mode to auto-generate a table config per bucket.")
@@ -0,0 +1,154 @@
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import tap_spreadsheets_anywhere.conversion as conversion
+
+LOGGER = logging.getLogger(__name__)
+
+# Only strings that Python's int()/float() would read identically are cast by Arrow. Anything else in a
+# column (unicode digits, underscores, padding, hex...) sends that column through the per-cell coercer.
+INTEGER_PATTERN = r"^[+-]?[0-9]+$"
+NUMBER_PATTERN = r"^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$"
+
+
+def compile_batch_converter(schema):
+    """
+    Returns a function that converts a record batch, whose columns carry normalized names, into an
+    iterator of rows coerced against the stream schema. Columns are coerced with Arrow compute where
+    the result is known to match conversion.coerce, and cell by cell with the same coercer otherwise.
+    """
+    properties = schema.get('properties', {})
+    column_converters = {}
+
+    def get_column_converter(name):
+        if name not in column_converters:
+            declared_types = properties[name].get('type', ['null', 'string']) if name in properties \
+                else ['string', 'null']
+            column_converters[name] = _compile_column_converter(declared_types)
+        return column_converters[name]
+
+    def converter(batch):
+        names = batch.schema.names
+        columns = [get_column_converter(name)(column) for name, column in zip(names, batch.columns)]
+        for values in zip(*columns):
+            yield dict(zip(names, values))
+
+    return converter
+
+
+def convert_batches(batches, schema):
+    converter = compile_batch_converter(schema)
+    for batch in batches:
+        yield from converter(batch)
+
+
+def skip_rows(batches, count):
+    for batch in batches:
+        if count >= batch.num_rows:
+            count -= batch.num_rows
+            continue
+        if count:
+            batch = batch.slice(count)
+            count = 0
+        yield batch
+
+
+def rows_from_batches(batches):
+    for batch in batches:
+        names = batch.schema.names
+        for values in zip(*(column.to_pylist() for column in batch.columns)):
+            yield dict(zip(names, values))
+
+
+def _compile_column_converter(declared_types):
+    desired_type = conversion.desired_type_of(declared_types)
+    coercer = conversion.get_coercer(declared_types)
+
+    def convert_cells(column):
+        return [coercer(value) for value in column.to_pylist()]
+
+    def convert_column(column):
+        if pa.types.is_dictionary(column.type):
+            column = column.dictionary_decode()
+        if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            converted = _convert_string_column(column, desired_type)
+        else:
+            converted = _convert_typed_column(column, desired_type)
+        # NaN and infinities go through the coercer, which rejects them
+        if converted is not None and (not pa.types.is_floating(converted.type) or
+                                      pc.all(pc.is_finite(converted), min_count=0).as_py()):
+            return converted.to_pylist()
+        return convert_cells(column)
+
+    return convert_column
+
+
+def _convert_typed_column(column, desired_type):
+    """
+    Converts an already typed column (as read from Parquet) where Arrow gives the same result as the
+    Python coercer, or renders timestamps and dates as ISO-8601 strings when a date-time is declared.
+    Returns None when the column has to be coerced cell by cell.
+    """
+    column_type = column.type
+    try:
+        if pa.types.is_integer(column_type):
+            if desired_type in ('integer', None):
+                return column
+            if desired_type == 'number':
+                return pc.cast(column, pa.float64())
+            # Python coerces integers to every other declared type with str()
+            return pc.cast(column, pa.string())
+        elif pa.types.is_floating(column_type) and desired_type in ('number', None):
+            return pc.cast(column, pa.float64())
+        elif desired_type == 'date-time' and (pa.types.is_timestamp(column_type) or pa.types.is_date(column_type)):
+            return _format_iso_timestamps(column)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        pass
+    return None
+
+
+def _format_iso_timestamps(column):
+    if pa.types.is_date(column.type):
+        column = pc.cast(column, pa.timestamp('s'))
+    elif column.type.tz is not None:
+        # Timestamps with a time zone are stored as UTC and rendered as such
+        column = pc.cast(column, pa.timestamp(column.type.unit, 'UTC'))
+
+    seconds = pc.cast(pc.floor_temporal(column, unit='second'), pa.timestamp('s', column.type.tz), safe=False)
+    formatted = pc.strftime(seconds, format='%Y-%m-%dT%H:%M:%S')
+    if column.type.unit != 's':
+        # Like datetime.isoformat(), only show microseconds when there are some
+        micros = pc.add(pc.multiply(pc.millisecond(column), 1000), pc.microsecond(column))
+        fraction = pc.utf8_lpad(pc.cast(micros, pa.string()), width=6, padding='0')
+        fraction = pc.if_else(pc.equal(micros, 0), '', pc.binary_join_element_wise('', fraction, '.'))
+        formatted = pc.binary_join_element_wise(formatted, fraction, '')
+    return pc.binary_join_element_wise(formatted, '+00:00', '')
+
+
+def _convert_string_column(column, desired_type):
+    if desired_type == 'integer':
+        pattern, target_type = INTEGER_PATTERN, pa.int64()
+    elif desired_type == 'number':
+        pattern, target_type = NUMBER_PATTERN, pa.float64()
+    elif desired_type in ('date-time', None):
+        return None
+    else:
+        # 'string', 'object' and any other declared type keep the text of non-blank values
+        return _blank_to_null(column)
+
+    values = _blank_to_null(column)
+    if not pc.all(pc.match_substring_regex(values, pattern), min_count=0).as_py():
+        return None
+    if desired_type == 'integer':
+        values = pc.replace_substring_regex(values, r"^\+", "")
+    try:
+        return pc.cast(values, target_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return None
+
+
+def _blank_to_null(column):
+    blank = pc.or_(pc.equal(column, ''), pc.utf8_is_space(column))
+    return pc.if_else(blank, pa.scalar(None, column.type), column)
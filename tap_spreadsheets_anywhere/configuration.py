@@ -6,6 +6,13 @@ from voluptuous import Schema, Required, Any, Optional
 LOGGER = logging.getLogger(__name__)
 
 CONFIG_CONTRACT = Schema({
+    Optional('max_parallel_streams'): int,
+    Optional('max_parallel_discovery'): int,
+    Optional('output_buffer_bytes'): int,
+    Optional('output_flush_seconds'): Any(int, float),
+    Optional('listing_cache_dir'): str,
+    Optional('listing_cache_max_age'): Any(int, float),
+    Optional('schema_cache_dir'): str,
     Required('tables'): [{
         Required('path'): str,
         Required('name'): str,
@@ -14,20 +21,32 @@ CONFIG_CONTRACT = Schema({
         Required('key_properties'): [str],
         Required('format'): Any('csv', 'excel', 'json', 'jsonl', 'parquet', 'detect'),
         Optional('encoding'): str,
+        Optional('engine'): Any('python', 'arrow', 'stream'),
         Optional('invalid_format_action'): Any('ignore','fail'),
         Optional('universal_newlines'): bool,
         Optional('skip_initial'): int,
         Optional('selected'): bool,
         Optional('field_names'): [str],
         Optional('search_prefix'): str,
+        Optional('incremental_listing'): bool,
+        Optional('max_parallel_listing'): int,
+        Optional('max_listed_files'): int,
         Optional('worksheet_name'): str,
+        Optional('worksheet_names'): [str],
         Optional('delimiter'): str,
         Optional('quotechar'): str,
         Optional('json_path'): str,
         Optional('sample_rate'): int,
         Optional('max_sampling_read'): int,
+        Optional('sampling'): Any('head', 'spread'),
+        Optional('sample_windows'): int,
+        Optional('sample_window_bytes'): int,
         Optional('max_records_per_run'): int,
+        Optional('max_parallel_files'): int,
         Optional('max_sampled_files'): int,
+        Optional('max_parallel_row_groups'): int,
+        Optional('spool_to_disk'): bool,
+        Optional('spool_memory_bytes'): int,
         Optional('prefer_number_vs_integer'): bool,
         Optional('prefer_schema_as_string'): bool,
         Optional('schema_overrides'): {
@@ -1,42 +1,242 @@
 import dateutil
 import pytz
 import logging
-import pickle
+import math
+import re
 from collections.abc import MutableMapping
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
 
 LOGGER = logging.getLogger(__name__)
 
+# Patterns (RE2 syntax) that decide the datatype convert() gives an ASCII string. ASCII whitespace is what
+# str.strip() and float() skip. NUMERIC_PATTERN accepts everything int() and float() accept (and more), so
+# that ASCII strings matching neither it nor SPECIAL_FLOAT_PATTERN are text.
+ASCII_WHITESPACE = r"[ \t\n\r\x0b\x0c\x1c-\x1f]"
+BLANK_PATTERN = rf"^{ASCII_WHITESPACE}*$"
+INTEGER_PATTERN = r"^[+-]?[0-9]+$"
+NUMBER_PATTERN = r"^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$"
+NUMERIC_PATTERN = rf"^{ASCII_WHITESPACE}*[+-]?([0-9_]+\.?[0-9_]*|\.[0-9_]+)([eE][+-]?[0-9_]+)?{ASCII_WHITESPACE}*$"
+SPECIAL_FLOAT_PATTERN = rf"(?i)^{ASCII_WHITESPACE}*[+-]?(nan|inf|infinity){ASCII_WHITESPACE}*$"
+
+# Date-time shapes that a column's coercer can learn from its first values. Each is parsed without dateutil,
+# and only where dateutil gives the same result: day and month order follow dateutil's month-first default,
+# and the patterns pin down the digits so that strptime can't read a value differently than dateutil would.
+ISO_DATE_TIME_PATTERN = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})"
+                                   r"(?:[T ]([0-9]{2}):([0-9]{2})(?::([0-9]{2})(?:\.([0-9]{1,6}))?)?"
+                                   r"(Z|([+-])([0-9]{2}):?([0-9]{2}))?)?", re.ASCII)
+STRPTIME_FORMATS = [
+    (r"[0-9]{1,2}/[0-9]{1,2}/[0-9]{4}", '%m/%d/%Y'),
+    (r"[0-9]{1,2}/[0-9]{1,2}/[0-9]{4} [0-9]{1,2}:[0-9]{2}", '%m/%d/%Y %H:%M'),
+    (r"[0-9]{1,2}/[0-9]{1,2}/[0-9]{4} [0-9]{1,2}:[0-9]{2}:[0-9]{2}", '%m/%d/%Y %H:%M:%S'),
+    (r"[0-9]{4}/[0-9]{1,2}/[0-9]{1,2}", '%Y/%m/%d'),
+    (r"[0-9]{4}/[0-9]{1,2}/[0-9]{1,2} [0-9]{1,2}:[0-9]{2}:[0-9]{2}", '%Y/%m/%d %H:%M:%S'),
+    (r"[0-9]{1,2} [A-Za-z]{3} [0-9]{4}", '%d %b %Y'),
+    (r"[0-9]{1,2}-[A-Za-z]{3}-[0-9]{4}", '%d-%b-%Y'),
+]
+# How many values a date-time column parses with dateutil while looking for a format, before it stops looking
+DATE_TIME_LEARNING_VALUES = 100
+
 
 def convert_row(row, schema):
-    t_schema = pickle.loads(pickle.dumps(schema))
-    to_return = {}
-    for key, value in row.items():
-        if key in t_schema['properties']:
-            field_schema = t_schema['properties'][key]
-            declared_types = field_schema.get('type', ['null', 'string'])
-        else:
-            declared_types = ['string','null']
+    return compile_row_converter(schema)(row)
 
-        LOGGER.debug('Converting {} value {} to {}'.format(key, value, declared_types))
-        coerced = coerce(value, declared_types)
-        to_return[key] = coerced
 
-    return to_return
+def compile_row_converter(schema):
+    """
+    Builds the field->coercer table for a stream schema once and returns a function that
+    converts a row with it. Produces the same output as convert_row without the per-row
+    schema copy or per-cell type lookup.
+    """
+    coercers = {key: get_coercer(field_schema.get('type', ['null', 'string']))
+                for key, field_schema in schema.get('properties', {}).items()}
+    default_coercer = get_coercer(['string', 'null'])
+
+    def converter(row):
+        return {key: coercers.get(key, default_coercer)(value) for key, value in row.items()}
+
+    return converter
+
+
+def desired_type_of(declared_types):
+    if isinstance(declared_types, list):
+        non_null_types = [t for t in declared_types if t != 'null']
+        return non_null_types[0] if non_null_types else None
+    return declared_types
+
+
+def get_coercer(declared_types):
+    """
+    Returns a single-argument function behaving like coerce(datum, declared_types).
+    """
+    desired_type = desired_type_of(declared_types)
+    if desired_type is None:
+        convert_datum = _convert_untyped
+    elif desired_type == 'date-time':
+        convert_datum = _compile_date_time_converter()
+    else:
+        convert_datum = _DATUM_CONVERTERS.get(desired_type, str)
+
+    def coercer(datum):
+        if datum is None or str(datum).strip() == '':
+            return None
+        return convert_datum(datum)
+
+    return coercer
+
 
 def coerce(datum,declared_types):
     if datum is None or datum == '':
         return None
 
-    desired_type = declared_types.copy()
-    if isinstance(desired_type, list):
-        if "null" in desired_type:
-            desired_type.remove("null")
-        desired_type = desired_type[0]
+    desired_type = desired_type_of(declared_types)
 
     coerced, _ = convert(datum, desired_type)
     return coerced
 
 
+def _convert_integer(datum):
+    try:
+        datum_int = int(datum)
+        if str(datum).lstrip("-+").isdigit():
+            return datum_int
+    except (ValueError, TypeError):
+        pass
+    return str(datum)
+
+
+def _convert_number(datum):
+    try:
+        datum_float = float(datum)
+    except (ValueError, TypeError):
+        return str(datum)
+    return _json_compliant(datum_float)
+
+
+def _convert_date_time(datum):
+    try:
+        return _parse_date_time(datum).isoformat()
+    except (ValueError, TypeError):
+        return str(datum)
+
+
+def _parse_date_time(datum):
+    to_return = dateutil.parser.parse(datum)
+
+    if (to_return.tzinfo is None or
+            to_return.tzinfo.utcoffset(to_return) is None):
+        to_return = to_return.replace(tzinfo=pytz.utc)
+
+    return to_return
+
+
+def _parse_iso_date_time(match):
+    year, month, day, hour, minute, second, fraction, tz, sign, tz_hours, tz_minutes = match.groups()
+    if tz is None:
+        tzinfo = pytz.utc
+    elif tz == 'Z':
+        tzinfo = timezone.utc
+    else:
+        offset = timedelta(hours=int(tz_hours), minutes=int(tz_minutes))
+        tzinfo = timezone(-offset if sign == '-' else offset)
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                    int(fraction.ljust(6, '0')) if fraction else 0, tzinfo=tzinfo)
+
+
+def _strptime_parser(date_format):
+    def parse(match):
+        return datetime.strptime(match.string, date_format).replace(tzinfo=pytz.utc)
+    return parse
+
+
+DATE_TIME_PARSERS = [(ISO_DATE_TIME_PATTERN, _parse_iso_date_time)] + \
+    [(re.compile(pattern, re.ASCII), _strptime_parser(date_format)) for pattern, date_format in STRPTIME_FORMATS]
+
+
+def _compile_date_time_converter():
+    """
+    Returns a function behaving like _convert_date_time that learns the format of a column. When a value
+    parsed by dateutil also matches one of DATE_TIME_PARSERS with the same result, later values are parsed
+    with that parser, and go back to dateutil (and to learning) when they don't match it.
+    """
+    learned = {'parser': None, 'misses': 0}
+
+    def convert_date_time(datum):
+        parser = learned['parser']
+        if parser is not None and type(datum) is str:
+            match = parser[0].fullmatch(datum)
+            if match is not None:
+                try:
+                    return parser[1](match).isoformat()
+                except ValueError:
+                    pass
+
+        try:
+            to_return = _parse_date_time(datum).isoformat()
+        except (ValueError, TypeError):
+            return str(datum)
+
+        if learned['misses'] < DATE_TIME_LEARNING_VALUES:
+            learned['misses'] += 1
+            learned['parser'] = _learn_date_time_parser(datum, to_return)
+        return to_return
+
+    return convert_date_time
+
+
+def _learn_date_time_parser(datum, expected):
+    if type(datum) is not str:
+        return None
+    for pattern, parse in DATE_TIME_PARSERS:
+        match = pattern.fullmatch(datum)
+        if match is None:
+            continue
+        try:
+            if parse(match).isoformat() == expected:
+                return pattern, parse
+        except ValueError:
+            pass
+    return None
+
+
+def _convert_object(datum):
+    if isinstance(datum, MutableMapping):
+        return _json_compliant(datum)
+    return str(datum)
+
+
+def _convert_untyped(datum):
+    return _json_compliant(convert(datum)[0])
+
+
+def _json_compliant(value):
+    """
+    Returns a converted value unchanged, or raises a ValueError when it holds NaN or an infinity, which JSON
+    can not represent and which singer's encoder refuses. They are caught here, once per value, so that
+    records can be serialized without looking for them again.
+    """
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError(f"Out of range float values are not JSON compliant: {value!r}")
+    elif isinstance(value, MutableMapping):
+        for item in value.values():
+            _json_compliant(item)
+    elif isinstance(value, list):
+        for item in value:
+            _json_compliant(item)
+    return value
+
+
+_DATUM_CONVERTERS = {
+    'integer': _convert_integer,
+    'number': _convert_number,
+    'date-time': _convert_date_time,
+    'object': _convert_object,
+}
+
+
 def convert(datum, desired_type=None):
     """
     Returns tuple of (converted_data_point, json_schema_type,).
@@ -98,12 +298,85 @@ def count_sample(sample, start=None):
 
 
 def count_samples(samples):
-    to_return = {}
-
+    """
+    Returns the same histograms as calling count_sample on every sample, but classifies each column's
+    values at once with count_column.
+    """
+    columns = {}
     for sample in samples:
-        to_return = count_sample(sample, to_return)
+        for key, value in sample.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = []
+            column.append(value)
 
-    return to_return
+    return {key: count_column(values) for key, values in columns.items()}
+
+
+def count_column(values):
+    """
+    Returns the histogram of the json schema types that convert() gives a column of values, with types in
+    the order they first appear. String values are classified together with Arrow where a pattern decides
+    their type for certain, and the others (non-ASCII text, 'nan', '1_000', padded numbers...) go through
+    convert() one by one.
+    """
+    counts = {}
+    first_positions = {}
+
+    def add(datatype, position, count=1):
+        counts[datatype] = counts.get(datatype, 0) + count
+        first_positions[datatype] = min(position, first_positions.get(datatype, position))
+
+    strings, string_positions = [], []
+    for position, value in enumerate(values):
+        if type(value) is str:
+            strings.append(value)
+            string_positions.append(position)
+        elif type(value) is int:
+            add('integer', position)
+        else:
+            (_, datatype) = convert(value)
+            if datatype is not None:
+                add(datatype, position)
+
+    if strings:
+        decided, undecided = _classify_strings(strings)
+        for datatype, first_index, count in decided:
+            add(datatype, string_positions[first_index], count)
+        for index in undecided:
+            (_, datatype) = convert(strings[index])
+            if datatype is not None:
+                add(datatype, string_positions[index])
+
+    return {datatype: counts[datatype] for datatype in sorted(counts, key=first_positions.get)}
+
+
+def _classify_strings(strings):
+    """
+    Returns a list of (datatype, first index, count) for the string values whose datatype the patterns
+    decide, and the indexes of the values left to convert().
+    """
+    try:
+        column = pa.array(strings, pa.string())
+    except (pa.ArrowException, UnicodeEncodeError):
+        # e.g. undecodable bytes kept as surrogates
+        return [], range(len(strings))
+
+    is_ascii = pc.string_is_ascii(column)
+    blank = pc.and_(is_ascii, pc.match_substring_regex(column, BLANK_PATTERN))
+    integer = pc.and_(is_ascii, pc.match_substring_regex(column, INTEGER_PATTERN))
+    number = pc.and_(pc.and_(is_ascii, pc.invert(integer)), pc.match_substring_regex(column, NUMBER_PATTERN))
+    maybe_numeric = pc.or_(pc.match_substring_regex(column, NUMERIC_PATTERN),
+                           pc.match_substring_regex(column, SPECIAL_FLOAT_PATTERN))
+    string = pc.and_(pc.and_(is_ascii, pc.invert(blank)), pc.invert(maybe_numeric))
+
+    decided = []
+    for datatype, mask in (('integer', integer), ('number', number), ('string', string)):
+        count = pc.sum(mask).as_py()
+        if count:
+            decided.append((datatype, pc.index(mask, True).as_py(), count))
+    undecided = pc.invert(pc.or_(pc.or_(blank, integer), pc.or_(number, string)))
+    return decided, pc.indices_nonzero(undecided).to_pylist()
 
 
 def pick_datatype(counts,prefer_number_vs_integer=False):
@@ -140,9 +413,27 @@ def pick_datatype(counts,prefer_number_vs_integer=False):
     return to_return
 
 
+def merge_counts(histograms):
+    """
+    Adds up the histograms of consecutive sample lists, keeping keys and types in the order they first
+    appear, so that the result equals count_samples of the concatenated samples.
+    """
+    merged = {}
+    for counts in histograms:
+        for key, value in counts.items():
+            merged_value = merged.setdefault(key, {})
+            for datatype, count in value.items():
+                merged_value[datatype] = merged_value.get(datatype, 0) + count
+    return merged
+
+
 def generate_schema(samples,prefer_number_vs_integer=False, prefer_schema_as_string=False):
+    return generate_schema_from_counts(count_samples(samples), prefer_number_vs_integer=prefer_number_vs_integer,
+                                       prefer_schema_as_string=prefer_schema_as_string)
+
+
+def generate_schema_from_counts(counts,prefer_number_vs_integer=False, prefer_schema_as_string=False):
     to_return = {}
-    counts = count_samples(samples)
 
     for key, value in counts.items():
         if(prefer_schema_as_string):
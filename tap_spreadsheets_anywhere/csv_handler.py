@@ -1,25 +1,42 @@
 import csv
-import re
 import logging
 
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from tap_spreadsheets_anywhere.normalization import normalize_header, EXTRA_FIELDS_KEY
+
 LOGGER = logging.getLogger(__name__)
 
-def generator_wrapper(reader):
+def generator_wrapper(reader, field_names=None):
+    """
+    Mirrors csv.DictReader over a csv.reader, but normalizes the header once per file and
+    builds each row by zipping it with the row values.
+    """
+    if field_names is None:
+        field_names = next(reader, None)
+        if field_names is None:
+            return
+    header = normalize_header(field_names)
+    header_length = len(header)
     for row in reader:
-        to_return = {}
-        for key, value in row.items():
-            if key is None:
-                key = '_smart_extra'
+        if not row:
+            continue
+        to_return = dict(zip(header, row))
+        row_length = len(row)
+        if header_length < row_length:
+            to_return[EXTRA_FIELDS_KEY] = row[header_length:]
+        elif header_length > row_length:
+            for key in header[row_length:]:
+                to_return[key] = None
+        yield to_return
 
-            formatted_key = key
 
-            # remove non-word, non-whitespace characters
-            formatted_key = re.sub(r"[^\w\s]", '', formatted_key)
-
-            # replace whitespace with underscores
-            formatted_key = re.sub(r"\s+", '_', formatted_key)
-            to_return[formatted_key.lower()] = value
-        yield to_return
+def sniff_dialect(line):
+    try:
+        return csv.Sniffer().sniff(line, delimiters=[',', '\t', ';', ' ', ':', '|', ' '])
+    except Exception as err:
+        raise ValueError("Unable to sniff a delimiter")
 
 
 def get_row_iterator(table_spec, reader):
@@ -29,21 +46,57 @@ def get_row_iterator(table_spec, reader):
 
     dialect = 'excel'
     if 'delimiter' not in table_spec or table_spec['delimiter'] == 'detect':
-        try:
-            dialect = csv.Sniffer().sniff(reader.readline(), delimiters=[',', '\t', ';', ' ', ':', '|', ' '])
-            if reader.seekable():
-                reader.seek(0)
-        except Exception as err:
-            raise ValueError("Unable to sniff a delimiter")
+        dialect = sniff_dialect(reader.readline())
+        if reader.seekable():
+            reader.seek(0)
     else:
         custom_delimiter = table_spec.get('delimiter', ',')
         custom_quotechar = table_spec.get('quotechar', '"')
         if custom_delimiter != ',' or custom_quotechar != '"':
+            # Passed as a class rather than registered by name, so that files read concurrently keep their own dialect
             class custom_dialect(csv.excel):
                 delimiter = custom_delimiter
                 quotechar = custom_quotechar
-            dialect = 'custom_dialect'
-            csv.register_dialect(dialect, custom_dialect)
+            dialect = custom_dialect
+
+    reader = csv.reader(reader, dialect=dialect)
+    return generator_wrapper(reader, field_names)
+
+
+def get_batch_iterator(table_spec, reader, encoding='utf-8'):
+    """
+    Parses a binary stream with pyarrow's streaming CSV reader. Every column is read as a string,
+    exactly as csv.reader would hand it over, and each record batch carries the normalized header.
+    """
+    if not _has_data(reader):
+        return iter(())
+
+    delimiter = table_spec.get('delimiter', ',')
+    quotechar = table_spec.get('quotechar', '"')
+    if 'delimiter' not in table_spec or delimiter == 'detect':
+        dialect = sniff_dialect(reader.readline().decode(encoding, errors='surrogateescape'))
+        reader.seek(0)
+        delimiter, quotechar = dialect.delimiter, dialect.quotechar
+
+    parse_options = pacsv.ParseOptions(delimiter=delimiter, quote_char=quotechar, newlines_in_values=True)
+    field_names = table_spec.get('field_names')
+    if field_names is None:
+        # Let Arrow parse the header row once so that every column can then be declared a string
+        field_names = pacsv.open_csv(reader, read_options=pacsv.ReadOptions(encoding=encoding),
+                                     parse_options=parse_options).schema.names
+        reader.seek(0)
+        read_options = pacsv.ReadOptions(encoding=encoding)
+    else:
+        read_options = pacsv.ReadOptions(encoding=encoding, column_names=field_names)
+
+    convert_options = pacsv.ConvertOptions(column_types={name: pa.string() for name in field_names})
+    batches = pacsv.open_csv(reader, read_options=read_options, parse_options=parse_options,
+                             convert_options=convert_options)
+    header = normalize_header(field_names)
+    return (pa.RecordBatch.from_arrays(batch.columns, names=header) for batch in batches)
+
 
-    reader = csv.DictReader(reader, fieldnames=field_names, dialect=dialect)
-    return generator_wrapper(reader)
+def _has_data(reader):
+    has_data = len(reader.read(1)) > 0
+    reader.seek(0)
+    return has_data
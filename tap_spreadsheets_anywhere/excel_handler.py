@@ -1,12 +1,46 @@
-import re
 import openpyxl
 import logging
+import os
+import posixpath
+import struct
+import zipfile
+from array import array
+from xml.etree.ElementTree import XMLParser, iterparse, parse
 
 import xlrd
+from xlrd.biffh import XL_BOF, XL_DIMENSION, XL_DIMENSION2, XL_EOF
+from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+from openpyxl.utils.cell import coordinate_to_tuple, range_boundaries
+from openpyxl.utils.datetime import from_excel, from_ISO8601, WINDOWS_EPOCH, MAC_EPOCH
+from openpyxl.xml.constants import ARC_ROOT_RELS, PKG_REL_NS, REL_NS, SHEET_MAIN_NS
+
+from tap_spreadsheets_anywhere.normalization import normalize_header
+from tap_spreadsheets_anywhere.spooling import spool_to_local_file
 
 LOGGER = logging.getLogger(__name__)
 
+MAIN = '{%s}' % SHEET_MAIN_NS
+ROW_TAG = MAIN + 'row'
+CELL_TAG = MAIN + 'c'
+VALUE_TAG = MAIN + 'v'
+INLINE_STRING_TAG = MAIN + 'is'
+TEXT_TAG = MAIN + 't'
+PHONETIC_TAG = MAIN + 'rPh'
+SHEET_DATA_TAG = MAIN + 'sheetData'
+DIMENSION_TAG = MAIN + 'dimension'
+STRING_ITEM_TAG = MAIN + 'si'
+# Key of the worksheet name in records of tables reading several worksheets
+WORKSHEET_KEY = '_smart_source_worksheet'
+# Shared strings are joined into one string per this many strings while the table is read
+SHARED_STRINGS_CHUNK = 4096
+XML_READ_BYTES = 64 * 1024
+
+
 def generator_wrapper(reader, table_spec: dict={}) -> dict:
+    return values_generator_wrapper((tuple(cell.value for cell in row) for row in reader), table_spec)
+
+
+def values_generator_wrapper(reader, table_spec: dict={}) -> dict:
     skip_initial = table_spec.get("skip_initial", 0)
     _skip_count = 0
     header_row = None
@@ -16,83 +50,463 @@ def generator_wrapper(reader, table_spec: dict={}) -> dict:
             _skip_count += 1
             continue
 
-        to_return = {}
         if header_row is None:
-            header_row = row
+            header_row = normalize_header(_header_value(value) for value in row)
+            header_length = len(header_row)
             continue
 
-        for index, cell in enumerate(row):
-            header_cell = header_row[index]
-
-            formatted_key = header_cell.value
-            if not formatted_key:
-                formatted_key = '' # default to empty string for key
+        if len(row) > header_length:
+            raise IndexError(f"Row has {len(row)} cells but the header row only has {header_length}")
 
-            # remove non-word, non-whitespace characters
-            formatted_key = re.sub(r"[^\w\s]", '', formatted_key)
+        yield dict(zip(header_row, row))
 
-            # replace whitespace with underscores
-            formatted_key = re.sub(r"\s+", '_', formatted_key)
 
-            to_return[formatted_key.lower()] = cell.value
+def _header_value(value):
+    if not value:
+        return '' # default to empty string for key
+    return value if isinstance(value, str) else str(value)
 
-        yield to_return
 
 def get_legacy_row_iterator(table_spec, file_handle):
-    workbook = xlrd.open_workbook(on_demand=True,file_contents=file_handle.read())
-    if "worksheet_name" in table_spec:
-        try:
-            sheet = workbook.sheet_by_name(table_spec["worksheet_name"])
-        except Exception as e:
-            LOGGER.error("Unable to open specified sheet '"+table_spec["worksheet_name"]+"' - did you check the workbook's sheet name for spaces?")
-            raise e
-    else:
-        try:
-            sheet_name_list = workbook.sheet_names()
-            #if one sheet
-            if(workbook.nsheets == 1):
-                sheet = workbook.sheet_by_name(sheet_name_list[0])
-            #else picks sheet with most data found determined by number of rows
-            else:
-                sheet_list = workbook.sheets()
-                max_row = 0
-                max_name = ""
-                for i in sheet_list:
-                    if i.nrows > max_row:
-                        max_row = i.nrows
-                        max_name = i.name
-                sheet = workbook.sheet_by_name(max_name)
-        except Exception as e:
-            LOGGER.info(e)
-            sheet = workbook.sheet_by_name(sheet_name_list[0])
-    return generator_wrapper(sheet.get_rows(), table_spec)
+    """
+    Reads .xls rows from a local copy of the file, which xlrd memory-maps, so that the workbook is never
+    held in memory as a whole. Only the sheets read are loaded, and the copy is removed once the rows are
+    read or the iterator is closed.
+    """
+    path = spool_to_local_file(file_handle, '.xls')
+    try:
+        workbook = xlrd.open_workbook(path, on_demand=True, use_mmap=True)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    def sheet_rows(name):
+        sheet = workbook.sheet_by_name(name)
+        for row in sheet.get_rows():
+            yield tuple(cell.value for cell in row)
+        # Sheets are loaded on demand, so each one is released once read
+        workbook.unload_sheet(name)
+
+    def sheet_length(name):
+        return _legacy_dimension_rows(workbook, workbook.sheet_names().index(name))
+
+    try:
+        records = _select_worksheets(table_spec, workbook.sheet_names(), sheet_rows, sheet_length)
+    except BaseException:
+        _release_legacy_workbook(workbook, path)
+        raise
+    return _releasing_legacy_workbook(records, workbook, path)
+
+
+def _releasing_legacy_workbook(records, workbook, path):
+    try:
+        yield from records
+    finally:
+        _release_legacy_workbook(workbook, path)
+
+
+def _release_legacy_workbook(workbook, path):
+    # The memory map has to be closed before the file can be removed on Windows
+    workbook.release_resources()
+    os.remove(path)
+
+
+def _legacy_dimension_rows(workbook, sheet_index):
+    """
+    Returns the row count stored in the DIMENSIONS record of a sheet, which follows the sheet's BOF record,
+    without loading the sheet. Falls back to loading it when the record is missing, or when xlrd's private
+    attributes used to find it are not what they were when this was written.
+    """
+    try:
+        rows = _stored_dimension_rows(workbook, sheet_index)
+    except (AttributeError, IndexError, TypeError, struct.error) as err:
+        LOGGER.debug(f'Loading sheet {sheet_index} to count its rows: {err!r}')
+        rows = None
+    if rows is None:
+        return workbook.sheet_by_index(sheet_index).nrows
+    return rows
+
+
+def _stored_dimension_rows(workbook, sheet_index):
+    start = position = workbook._sh_abs_posn[sheet_index]
+    while 0 <= position and position + 4 <= len(workbook.mem):
+        code, length = struct.unpack('<HH', workbook.mem[position:position + 4])
+        data = workbook.mem[position + 4:position + 4 + length]
+        if code in (XL_DIMENSION, XL_DIMENSION2) and length:
+            # The same layouts xlrd reads when it loads the sheet
+            if workbook.biff_version < 80:
+                return struct.unpack('<H', data[2:4])[0]
+            return struct.unpack('<i', data[4:8])[0]
+        if code == XL_EOF or (position > start and code == XL_BOF):
+            break
+        position += 4 + length
+    return None
 
 
 def get_row_iterator(table_spec, file_handle):
     workbook = openpyxl.load_workbook(file_handle, read_only=True)
-    
+
+    def sheet_length(name):
+        # Read-only worksheets are sized from the dimension stored at the top of the sheet
+        return workbook[name].max_row or 0
+
+    return _select_worksheets(table_spec, [worksheet.title for worksheet in workbook.worksheets],
+                              lambda name: workbook[name].values, sheet_length)
+
+
+def _select_worksheets(table_spec, sheet_names, sheet_rows, sheet_length):
+    """
+    Returns the records of the worksheets a table reads: those listed in `worksheet_names`, the one named by
+    `worksheet_name`, or else the longest sheet, the first one on ties. `sheet_rows(name)` gives a sheet's
+    value rows and `sheet_length(name)` its row count without reading it.
+    """
+    if "worksheet_names" in table_spec:
+        missing = [name for name in table_spec["worksheet_names"] if name not in sheet_names]
+        if missing:
+            LOGGER.error(f"Unable to open specified sheets {missing} - did you check the workbook's sheet names for spaces?")
+            raise KeyError(f"Worksheets {missing} do not exist.")
+        return _worksheets_records(table_spec, sheet_rows)
+
     if "worksheet_name" in table_spec:
-        try:
-            active_sheet = workbook[table_spec["worksheet_name"]]
-        except Exception as e:
+        if table_spec["worksheet_name"] not in sheet_names:
             LOGGER.error("Unable to open specified sheet '"+table_spec["worksheet_name"]+"' - did you check the workbook's sheet name for spaces?")
-            raise e
+            raise KeyError(f"Worksheet {table_spec['worksheet_name']} does not exist.")
+        name = table_spec["worksheet_name"]
     else:
-        try:
-            worksheets = workbook.worksheets
-            #if one sheet
-            if(len(worksheets) == 1):
-                active_sheet = worksheets[0]
-            #else picks sheet with most data found determined by number of rows
-            else:
-                max_row = 0
-                longest_sheet_index = 0
-                for i, sheet in enumerate(worksheets):
-                    if sheet.max_row > max_row:
-                        max_row = i.max_row
-                        longest_sheet_index = i
-                active_sheet = worksheets[longest_sheet_index]
-        except Exception as e:
-            LOGGER.info(e)
-            active_sheet = worksheets[0]
-    return generator_wrapper(active_sheet, table_spec)
+        #picks sheet with most data found determined by number of rows
+        name = sheet_names[0]
+        if len(sheet_names) > 1:
+            max_row = 0
+            for sheet_name in sheet_names:
+                length = sheet_length(sheet_name)
+                if length > max_row:
+                    max_row = length
+                    name = sheet_name
+    return values_generator_wrapper(sheet_rows(name), table_spec)
+
+
+def _worksheets_records(table_spec, sheet_rows):
+    """Yields the records of each sheet in `worksheet_names`, read with its own header and skip_initial."""
+    for name in table_spec["worksheet_names"]:
+        for record in values_generator_wrapper(sheet_rows(name), table_spec):
+            record[WORKSHEET_KEY] = name
+            yield record
+
+
+def get_streaming_row_iterator(table_spec, file_handle):
+    """
+    Reads the rows of an xlsx workbook by parsing its worksheet XML incrementally from the archive, holding
+    plain values instead of openpyxl's cell objects. Rows hold the same values as with get_row_iterator,
+    except that formula cells hold the value last calculated by Excel instead of the formula.
+    """
+    archive = zipfile.ZipFile(file_handle)
+    workbook_path = _part_paths_by_type(_relationships(archive, ARC_ROOT_RELS, ''))['officeDocument']
+    workbook_relationships = _relationships(archive, posixpath.join(posixpath.dirname(workbook_path), '_rels',
+                                                                    posixpath.basename(workbook_path) + '.rels'),
+                                            workbook_path)
+    parts = _part_paths_by_type(workbook_relationships)
+    # Chartsheets have no rows
+    worksheet_paths = {rel_id: path for rel_id, rel_type, path in workbook_relationships if rel_type == 'worksheet'}
+
+    workbook = parse(archive.open(workbook_path)).getroot()
+    properties = workbook.find(MAIN + 'workbookPr')
+    epoch = MAC_EPOCH if properties is not None and properties.get('date1904') in ('1', 'true') else WINDOWS_EPOCH
+    sheet_paths = {sheet.get('name'): worksheet_paths[sheet.get('{%s}id' % REL_NS)] for sheet in workbook.iter(MAIN + 'sheet')
+                   if sheet.get('{%s}id' % REL_NS) in worksheet_paths}
+
+    shared_strings = _read_shared_strings(archive, parts['sharedStrings']) if 'sharedStrings' in parts else []
+    date_styles, timedelta_styles = _read_date_styles(archive, parts['styles']) if 'styles' in parts else (set(), set())
+    cell_parser = _compile_cell_parser(shared_strings, date_styles, timedelta_styles, epoch)
+
+    def sheet_rows(name):
+        return _iter_sheet_rows(archive, sheet_paths[name], _read_dimensions(archive, sheet_paths[name]), cell_parser)
+
+    def sheet_length(name):
+        return _read_dimensions(archive, sheet_paths[name])[1] or 0
+
+    return _select_worksheets(table_spec, list(sheet_paths), sheet_rows, sheet_length)
+
+
+def _relationships(archive, rels_path, source_path):
+    """Returns (id, type, archive path) for each relationship in a .rels part."""
+    relationships = []
+    if rels_path not in archive.namelist():
+        return relationships
+    for relationship in parse(archive.open(rels_path)).getroot().iter('{%s}Relationship' % PKG_REL_NS):
+        target = relationship.get('Target')
+        if target.startswith('/'):
+            path = target.lstrip('/')
+        else:
+            path = posixpath.normpath(posixpath.join(posixpath.dirname(source_path), target))
+        relationships.append((relationship.get('Id'), relationship.get('Type').rsplit('/', 1)[-1], path))
+    return relationships
+
+
+def _part_paths_by_type(relationships):
+    paths = {}
+    for _, rel_type, path in relationships:
+        paths.setdefault(rel_type, path)
+    return paths
+
+
+def _read_dimensions(archive, sheet_path):
+    """Returns the (max column, max row) a worksheet declares, like openpyxl's read-only worksheets."""
+    with archive.open(sheet_path) as source:
+        for _, element in iterparse(source, events=('start',)):
+            if element.tag == DIMENSION_TAG:
+                _, _, max_col, max_row = range_boundaries(element.get('ref'))
+                return max_col, max_row
+            elif element.tag == SHEET_DATA_TAG:
+                break
+    return None, None
+
+
+def _feed(archive, path, target):
+    """Parses an archive part into an XMLParser target, yielding after each chunk so the target can be drained."""
+    parser = XMLParser(target=target)
+    with archive.open(path) as source:
+        for chunk in iter(lambda: source.read(XML_READ_BYTES), b''):
+            parser.feed(chunk)
+            yield
+    parser.close()
+
+
+class _TextCollector():
+    """
+    Collects the text of <t> elements that are not part of a phonetic run, like openpyxl's Text.content,
+    between begin() and end_text().
+    """
+
+    def __init__(self):
+        self.snippets = None
+        self.text = None
+        self.phonetic = False
+
+    def begin(self):
+        self.snippets = []
+
+    def end_text(self):
+        text = ''.join(self.snippets)
+        self.snippets = None
+        return text
+
+    def start(self, tag, attrib):
+        if tag == TEXT_TAG and self.snippets is not None and not self.phonetic:
+            self.text = []
+        elif tag == PHONETIC_TAG:
+            self.phonetic = True
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if tag == TEXT_TAG and self.text is not None:
+            self.snippets.append(''.join(self.text))
+            self.text = None
+        elif tag == PHONETIC_TAG:
+            self.phonetic = False
+
+
+class _SharedStringsTarget(_TextCollector):
+
+    def __init__(self):
+        super().__init__()
+        self.strings = []
+
+    def start(self, tag, attrib):
+        if tag == STRING_ITEM_TAG:
+            self.begin()
+        else:
+            super().start(tag, attrib)
+
+    def end(self, tag):
+        if tag == STRING_ITEM_TAG:
+            self.strings.append(self.end_text().replace('x005F_', ''))
+        else:
+            super().end(tag)
+
+
+class _RowsTarget(_TextCollector):
+    """
+    Turns the <row> elements of a worksheet into (row number, [(column, value)]) without building an element
+    tree, so that memory does not grow with the sheet. Parsed rows wait in `rows` until they are taken.
+    """
+
+    def __init__(self, parse_cell):
+        super().__init__()
+        self.parse_cell = parse_cell
+        self.rows = []
+        self.row_counter = 0
+        self.cells = None
+        self.column = 0
+        self.cell = None
+        self.value = None
+        self.inline_string = None
+        self.value_text = None
+
+    def start(self, tag, attrib):
+        if tag == CELL_TAG:
+            self.cell = attrib
+            self.value = self.inline_string = None
+        elif tag == VALUE_TAG and self.cell is not None:
+            self.value_text = []
+        elif tag == INLINE_STRING_TAG:
+            self.begin()
+        elif tag == ROW_TAG:
+            self.row_counter = int(attrib['r']) if 'r' in attrib else self.row_counter + 1
+            self.cells = []
+            self.column = 0
+        else:
+            super().start(tag, attrib)
+
+    def data(self, data):
+        if self.value_text is not None:
+            self.value_text.append(data)
+        else:
+            super().data(data)
+
+    def end(self, tag):
+        if tag == CELL_TAG:
+            coordinate = self.cell.get('r')
+            self.column = coordinate_to_tuple(coordinate)[1] if coordinate else self.column + 1
+            self.cells.append((self.column, self.parse_cell(self.cell, self.value, self.inline_string)))
+            self.cell = None
+        elif tag == VALUE_TAG and self.value_text is not None:
+            self.value = ''.join(self.value_text) or None
+            self.value_text = None
+        elif tag == INLINE_STRING_TAG:
+            self.inline_string = self.end_text()
+        elif tag == ROW_TAG:
+            self.rows.append((self.row_counter, self.cells))
+        else:
+            super().end(tag)
+
+
+class SharedStrings():
+    """
+    The shared strings table of a workbook, held as a few long strings and an array of offsets rather than
+    one string object per entry.
+    """
+
+    def __init__(self, strings):
+        self.chunks = []
+        self.offsets = array('q', [0])
+        pending = []
+        for string in strings:
+            pending.append(string)
+            self.offsets.append(self.offsets[-1] + len(string))
+            if len(pending) == SHARED_STRINGS_CHUNK:
+                self.chunks.append(''.join(pending))
+                pending = []
+        self.chunks.append(''.join(pending))
+        self.chunk_starts = [self.offsets[index * SHARED_STRINGS_CHUNK] for index in range(len(self.chunks))]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(f'Shared string {index} does not exist')
+        chunk = index // SHARED_STRINGS_CHUNK
+        start = self.chunk_starts[chunk]
+        return self.chunks[chunk][self.offsets[index] - start:self.offsets[index + 1] - start]
+
+
+def _read_shared_strings(archive, path):
+    def strings():
+        target = _SharedStringsTarget()
+        for _ in _feed(archive, path, target):
+            yield from target.strings
+            target.strings = []
+    return SharedStrings(strings())
+
+
+def _read_date_styles(archive, path):
+    """Returns the indexes of the cell styles whose number format shows dates, and of those showing durations."""
+    stylesheet = parse(archive.open(path)).getroot()
+    custom_formats = {int(fmt.get('numFmtId')): fmt.get('formatCode')
+                      for fmt in stylesheet.iterfind(f'{MAIN}numFmts/{MAIN}numFmt')}
+    date_styles, timedelta_styles = set(), set()
+    for index, xf in enumerate(stylesheet.iterfind(f'{MAIN}cellXfs/{MAIN}xf')):
+        format_id = int(xf.get('numFmtId', 0))
+        fmt = custom_formats[format_id] if format_id in custom_formats else builtin_format_code(format_id)
+        if is_date_format(fmt):
+            date_styles.add(index)
+        if is_timedelta_format(fmt):
+            timedelta_styles.add(index)
+    return date_styles, timedelta_styles
+
+
+def _compile_cell_parser(shared_strings, date_styles, timedelta_styles, epoch):
+    """Returns a function converting a cell's attributes and <v> or inline string text as openpyxl would."""
+    def parse_cell(attrib, value, inline_string):
+        data_type = attrib.get('t', 'n')
+        if data_type == 'inlineStr':
+            return inline_string
+        if value is None:
+            return None
+        if data_type == 'n':
+            value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+            style_id = int(attrib.get('s', 0))
+            if style_id in date_styles:
+                try:
+                    return from_excel(value, epoch, timedelta=style_id in timedelta_styles)
+                except (OverflowError, ValueError):
+                    return '#VALUE!'
+            return value
+        elif data_type == 's':
+            return shared_strings[int(value)]
+        elif data_type == 'b':
+            return bool(int(value))
+        elif data_type == 'd':
+            return from_ISO8601(value)
+        # 'str' (formula results) and 'e' (errors) hold their text
+        return value
+
+    return parse_cell
+
+
+def _parse_rows(archive, sheet_path, parse_cell):
+    target = _RowsTarget(parse_cell)
+    for _ in _feed(archive, sheet_path, target):
+        rows, target.rows = target.rows, []
+        yield from rows
+
+
+def _iter_sheet_rows(archive, sheet_path, dimensions, parse_cell):
+    """
+    Yields value tuples shaped like the rows of openpyxl's read-only worksheets: missing rows are filled in
+    and each row is padded or cut to the declared max column.
+    """
+    max_col, max_row = dimensions
+    empty_row = (None,) * max_col if max_col is not None else ()
+
+    counter = 1
+    idx = 1
+    for idx, cells in _parse_rows(archive, sheet_path, parse_cell):
+        if max_row is not None and idx > max_row:
+            break
+
+        for _ in range(counter, idx):
+            counter += 1
+            yield empty_row
+
+        if counter <= idx:
+            counter += 1
+            yield _fill_row(cells, max_col)
+
+    if max_row is not None and max_row < idx:
+        for _ in range(counter, max_row + 1):
+            yield empty_row
+
+
+def _fill_row(cells, max_col):
+    if not cells and not max_col:
+        return ()
+    max_col = max_col or cells[-1][0]
+    row = [None] * max_col
+    for column, value in cells:
+        if 1 <= column <= max_col:
+            row[column - 1] = value
+    return tuple(row)
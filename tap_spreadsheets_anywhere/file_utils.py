@@ -1,23 +1,34 @@
+import heapq
 import re
 
 import pytz
 from datetime import datetime, timezone
 
 import dateutil
-import requests
-import singer
-import boto3
-from google.cloud import storage
+import email.utils
 import os, logging
-from os import walk
+import queue
+import threading
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 import tap_spreadsheets_anywhere.format_handler
+import tap_spreadsheets_anywhere.arrow_conversion
+import tap_spreadsheets_anywhere.listing_cache
+import tap_spreadsheets_anywhere.schema_cache
+import tap_spreadsheets_anywhere.transports
 import tap_spreadsheets_anywhere.conversion as conversion
+import tap_spreadsheets_anywhere.output as output
 import smart_open.ssh as ssh_transport
-from azure.storage.blob import BlobServiceClient
 import smart_open.ftp as ftp_transport
 
 LOGGER = logging.getLogger(__name__)
 
+PREFETCH_QUEUE_SIZE = 1000
+MAX_LISTED_FILES = 10000
+SAMPLE_WINDOWS = 8
+SAMPLE_WINDOW_BYTES = 64 * 1024
+
 
 def resolve_target_uri(table_spec, target_filename):
     protocol, bucket = parse_path(table_spec['path'])
@@ -38,23 +49,24 @@ def _hide_credentials(path):
     return path
 
 
-def write_file(target_filename, table_spec, schema, max_records=-1):
+def write_file(target_filename, table_spec, schema, max_records=-1, converter=None, records=None):
     LOGGER.info('Syncing file "{}".'.format(target_filename))
     target_uri = resolve_target_uri(table_spec, target_filename)
+    source_bucket = _hide_credentials(table_spec['path'])
     records_synced = 0
     try:
-        iterator = tap_spreadsheets_anywhere.format_handler.get_row_iterator(table_spec, target_uri)
-        for row in iterator:
+        iterator = records if records is not None else read_records(table_spec, target_uri, schema, converter)
+        for record in iterator:
             metadata = {
-                '_smart_source_bucket': _hide_credentials(table_spec['path']),
+                '_smart_source_bucket': source_bucket,
                 '_smart_source_file': target_filename,
                 # index zero, +1 for header row
                 '_smart_source_lineno': records_synced + 2
             }
 
             try:
-                record_with_meta = {**conversion.convert_row(row, schema), **metadata}
-                singer.write_record(table_spec['name'], record_with_meta)
+                record_with_meta = {**record, **metadata}
+                output.write_record(table_spec['name'], record_with_meta)
             except BrokenPipeError as bpe:
                 LOGGER.error(
                     f'Pipe to loader broke after {records_synced} records were written from {target_filename}: troubled '
@@ -71,26 +83,139 @@ def write_file(target_filename, table_spec, schema, max_records=-1):
         else:
             raise ife
 
+    try:
+        output.flush()
+    except BrokenPipeError as bpe:
+        LOGGER.error(f'Pipe to loader broke while writing the last records from {target_filename}, after '
+                     f'{records_synced} records were handed over')
+        raise bpe
     return records_synced
 
 
-def sample_file(table_spec, target_filename, sample_rate, max_records):
-    LOGGER.info('Sampling {} ({} records, every {}th record).'
-                .format(target_filename, max_records, sample_rate))
+def read_records(table_spec, target_uri, schema, converter=None):
+    """
+    Yields the rows of a file coerced against the stream schema, column by column for formats read as
+    Arrow record batches and row by row otherwise.
+    """
+    # Detected once, as detection may open the file
+    format = tap_spreadsheets_anywhere.format_handler.detect_format(table_spec, target_uri)
+    batches = tap_spreadsheets_anywhere.format_handler.get_batch_iterator(table_spec, target_uri, format)
+    if batches is not None:
+        return tap_spreadsheets_anywhere.arrow_conversion.convert_batches(batches, schema)
+    if converter is None:
+        converter = conversion.compile_row_converter(schema)
+    return map(converter, tap_spreadsheets_anywhere.format_handler.get_row_iterator(table_spec, target_uri, format))
+
+
+class _WorkerError():
+    def __init__(self, error):
+        self.error = error
+
+
+_END_OF_FILE = object()
+
+
+def prefetch_files(target_files, table_spec, schema, max_parallel_files, converter=None,
+                   max_queued_records=PREFETCH_QUEUE_SIZE):
+    """
+    Opens, parses and converts up to `max_parallel_files` files concurrently on a worker pool and yields
+    `(target_file, records)` pairs in the order of `target_files`. Each file's records are handed over through
+    a bounded queue, and a worker's error is raised when its file's records are consumed.
+    """
+    stop = threading.Event()
 
+    def put(records_queue, item):
+        while not stop.is_set():
+            try:
+                records_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(target_file, records_queue):
+        try:
+            target_uri = resolve_target_uri(table_spec, target_file['key'])
+            for record in read_records(table_spec, target_uri, schema, converter):
+                if not put(records_queue, record):
+                    return
+            put(records_queue, _END_OF_FILE)
+        except Exception as err:
+            put(records_queue, _WorkerError(err))
+
+    def consume(records_queue):
+        while True:
+            item = records_queue.get()
+            if item is _END_OF_FILE:
+                return
+            if isinstance(item, _WorkerError):
+                raise item.error
+            yield item
+
+    executor = ThreadPoolExecutor(max_workers=max_parallel_files, thread_name_prefix='file-prefetch')
+    remaining_files = iter(target_files)
+    pending = deque()
+    futures = []
+
+    def submit_next():
+        target_file = next(remaining_files, None)
+        if target_file is not None:
+            records_queue = queue.Queue(maxsize=max_queued_records)
+            futures.append(executor.submit(produce, target_file, records_queue))
+            pending.append((target_file, records_queue))
+
+    try:
+        for _ in range(max_parallel_files):
+            submit_next()
+        while pending:
+            target_file, records_queue = pending.popleft()
+            submit_next()
+            yield target_file, consume(records_queue)
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def sample_file(table_spec, target_filename, sample_rate, max_records):
     target_uri = resolve_target_uri(table_spec,target_filename)
     samples = []
-    current_row = 0
     try:
-        iterator = tap_spreadsheets_anywhere.format_handler.get_row_iterator(table_spec, target_uri)
-
-        for row in iterator:
-            if (current_row % sample_rate) == 0:
-                samples.append(row)
+        format = tap_spreadsheets_anywhere.format_handler.detect_format(table_spec, target_uri)
+        windows = None
+        if table_spec.get('sampling', 'head') == 'spread':
+            windows = tap_spreadsheets_anywhere.format_handler.get_window_row_iterators(
+                table_spec, target_uri, table_spec.get('sample_windows', SAMPLE_WINDOWS),
+                table_spec.get('sample_window_bytes', SAMPLE_WINDOW_BYTES), format)
+
+        if windows is not None:
+            LOGGER.info('Sampling {} ({} records from {} windows spread over the file).'
+                        .format(target_filename, max_records, len(windows)))
+            records_per_window = -(-max_records // len(windows))
+            try:
+                for window in windows:
+                    samples += islice(window, min(records_per_window, max_records - len(samples)))
+            finally:
+                # Sampling stops early, so the files are closed here rather than once their rows run out
+                for window in windows:
+                    window.close()
+        else:
+            LOGGER.info('Sampling {} ({} records, every {}th record).'
+                        .format(target_filename, max_records, sample_rate))
+            iterator = tap_spreadsheets_anywhere.format_handler.get_row_iterator(table_spec, target_uri, format)
 
-            current_row += 1
-            if len(samples) >= max_records:
-                break
+            current_row = 0
+            try:
+                for row in iterator:
+                    if (current_row % sample_rate) == 0:
+                        samples.append(row)
+
+                    current_row += 1
+                    if len(samples) >= max_records:
+                        break
+            finally:
+                iterator.close()
     except tap_spreadsheets_anywhere.format_handler.InvalidFormatError as ife:
         if table_spec.get('invalid_format_action','fail').lower() != "ignore":
             raise ife
@@ -117,58 +242,130 @@ def sample_files(table_spec, target_files,
     return to_return
 
 
+def count_files_samples(table_spec, target_files,
+                        sample_rate=10, max_records=1000, max_files=5, executor=None):
+    """
+    Returns the type histograms of the samples that sample_files() would take, counted file by file so
+    that the histograms of files sampled by an earlier discovery can be reused from the schema cache.
+    """
+    def count_file(target_file):
+        return tap_spreadsheets_anywhere.schema_cache.get_counts(
+            table_spec, target_file, sample_rate, max_records,
+            lambda: conversion.count_samples(sample_file(table_spec, target_file['key'], sample_rate, max_records)))
+
+    files = islice(target_files, max(max_files, 1))
+    histograms = executor.map(count_file, list(files)) if executor is not None else map(count_file, files)
+    return conversion.merge_counts(histograms)
+
+
 def parse_path(path):
     path_parts = path.split('://', 1)
     return ('local', path_parts[0]) if len(path_parts) <= 1 else (path_parts[0], path_parts[1])
 
 
-def get_matching_objects(table_spec, modified_since=None):
+def list_objects(table_spec, start_after=None, modified_since=None, etag=None):
     protocol, bucket = parse_path(table_spec['path'])
 
     # TODO Breakout the transport schemes here similar to the registry/loading pattern used by smart_open
     if protocol == 's3':
-        target_objects = list_files_in_s3_bucket(bucket, table_spec.get('search_prefix'))
+        target_objects = list_files_in_s3_bucket(bucket, table_spec.get('search_prefix'), start_after=start_after,
+                                                 max_parallel_listing=table_spec.get('max_parallel_listing', 1))
     elif protocol == 'file':
-        target_objects = list_files_in_local_bucket(bucket, table_spec.get('search_prefix'))
+        target_objects = list_files_in_local_bucket(bucket, table_spec.get('search_prefix'),
+                                                    table_spec.get('max_listed_files', MAX_LISTED_FILES))
     elif protocol in ["sftp"]:
-        target_objects = list_files_in_SSH_bucket(table_spec['path'],table_spec.get('search_prefix'))
+        target_objects = list_files_in_SSH_bucket(table_spec['path'],table_spec.get('search_prefix'),
+                                                  table_spec.get('max_listed_files', MAX_LISTED_FILES))
     elif protocol in ["ftp"]:
-        target_objects = list_files_in_ftp_server(table_spec['path'],table_spec.get('search_prefix'))
+        target_objects = list_files_in_ftp_server(table_spec['path'],table_spec.get('search_prefix'),
+                                                  table_spec.get('max_listed_files', MAX_LISTED_FILES))
     elif protocol in ["gs"]:
         target_objects = list_files_in_gs_bucket(bucket,table_spec.get('search_prefix'))
     elif protocol in ["http", "https"]:
-        target_objects = convert_URL_to_file_list(table_spec)
+        target_objects = convert_URL_to_file_list(table_spec, modified_since, etag)
     elif protocol in ["azure"]:
         target_objects = list_files_in_azure_bucket(bucket,table_spec.get('search_prefix'))
     else:
         raise ValueError("Protocol {} not yet supported. Pull Requests are welcome!")
+    return target_objects
+
 
+def list_matching_objects(table_spec, start_after=None, modified_since=None, etag=None):
+    """
+    Lists the objects whose key matches the table's pattern, after `start_after` where the protocol supports it.
+    Returns them together with the greatest key that was listed. Protocols that support conditional requests
+    (HTTP) only check whether a file changed since `modified_since` or since it had the given `etag`.
+    """
+    target_objects = list_objects(table_spec, start_after, modified_since, etag)
     pattern = table_spec['pattern']
     matcher = re.compile(pattern)
-    if modified_since:
-        LOGGER.info(f'Checking {len(target_objects)} resolved objects for any that match regular expression "{pattern}" and were modified since {modified_since}')
-    else:
-        LOGGER.info(f'Checking {len(target_objects)} resolved objects for any that match regular expression "{pattern}"')
+    LOGGER.info(f'Checking resolved objects for any that match regular expression "{pattern}"')
 
-    to_return = []
+    matched = []
+    last_key = None
+    objects_checked = 0
     for obj in target_objects:
+        objects_checked += 1
         key = obj['Key']
-        last_modified = obj['LastModified']
+        if last_key is None or key > last_key:
+            last_key = key
+        if matcher.search(key):
+            matched.append({'key': key, 'last_modified': obj['LastModified']})
+            if 'ETag' in obj:
+                matched[-1]['etag'] = obj['ETag']
+        else:
+            LOGGER.debug('Not including key "{}"'.format(key))
+    LOGGER.info(f'{len(matched)} of {objects_checked} resolved objects match regular expression "{pattern}"')
+    return matched, last_key
+
+
+def get_matching_objects(table_spec, modified_since=None, etag=None, limit=None):
+    return list(iter_matching_objects(table_spec, modified_since, etag=etag, limit=limit))
+
+
+def iter_matching_objects(table_spec, modified_since=None, etag=None, limit=None):
+    """
+    Yields the objects of a table that match its pattern and were modified since `modified_since`, oldest
+    first. The whole matched listing is still held in memory, as the listing cache keeps it, so memory
+    stays linear in the number of matched objects. Objects are ordered lazily through a heap, which saves
+    the full sort when only the oldest objects are used, e.g. when max_records_per_run stops a sync early.
+    With a `limit`, as discovery passes, only the `limit` oldest objects are ordered.
+    """
+    matching_objects = tap_spreadsheets_anywhere.listing_cache.get_listing(
+        table_spec, lambda spec, start_after: list_matching_objects(spec, start_after, modified_since, etag))
+    if modified_since:
+        LOGGER.info(f'Checking {len(matching_objects)} matching objects for any that were modified since {modified_since}')
+
+    # The index keeps objects modified at the same time in listing order, as a stable sort would
+    candidates = ((obj['last_modified'], index, obj)
+                  for index, obj in enumerate(_modified_since(matching_objects, modified_since)))
+    if limit is not None and limit >= 0:
+        heap = heapq.nsmallest(limit, candidates)
+    else:
+        heap = list(candidates)
+        heapq.heapify(heap)
+
+    if not LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.info(f'Processing {len(heap)} resolved objects that met our criteria. Enable debug verbosity logging for more details.')
+    while heap:
+        yield dict(heapq.heappop(heap)[2])
+
+
+def _modified_since(objects, modified_since):
+    for obj in objects:
+        key = obj['key']
+        last_modified = obj['last_modified']
 
         # noinspection PyTypeChecker
-        if matcher.search(key) and (modified_since is None or modified_since < last_modified):
+        if modified_since is None or modified_since < last_modified:
             LOGGER.debug('Including key "{}"'.format(key))
             LOGGER.debug('Last modified: {}'.format(last_modified) + ' comparing to {} '.format(modified_since))
-            to_return.append({'key': key, 'last_modified': last_modified})
+            yield obj
         else:
             LOGGER.debug('Not including key "{}"'.format(key))
 
-    if not LOGGER.isEnabledFor(logging.DEBUG):
-        LOGGER.info(f'Processing {len(to_return)} resolved objects that met our criteria. Enable debug verbosity logging for more details.')
-    return sorted(to_return, key=lambda item: item['last_modified'])
-
 
-def list_files_in_SSH_bucket(uri, search_prefix=None):
+def list_files_in_SSH_bucket(uri, search_prefix=None, max_listed_files=MAX_LISTED_FILES):
     try:
         import paramiko
     except ImportError:
@@ -178,101 +375,145 @@ def list_files_in_SSH_bucket(uri, search_prefix=None):
         )
         raise
 
-    parsed_uri = ssh_transport.parse_uri(uri)
-    uri_path = parsed_uri.pop('uri_path')
-    transport_params={'connect_kwargs':{'allow_agent':False,'look_for_keys':False}}
-    ssh = ssh_transport._connect_ssh(parsed_uri['host'], parsed_uri['user'], parsed_uri['port'], parsed_uri['password'], transport_params.get('connect_kwargs'))
-    sftp_client = ssh.get_transport().open_sftp_client()
+    uri_path = ssh_transport.parse_uri(uri)['uri_path']
+    sftp_client = tap_spreadsheets_anywhere.transports.acquire_sftp_client(uri)
+    try:
+        listed = sftp_client.listdir_attr(uri_path)
+    finally:
+        tap_spreadsheets_anywhere.transports.release_sftp_client(uri, sftp_client)
     entries = []
-    max_results = 10000
+    max_results = max_listed_files
     from stat import S_ISREG
     import fnmatch
-    for entry in sftp_client.listdir_attr(uri_path):
+    for entry in listed:
         if search_prefix is None or fnmatch.fnmatch(entry.filename,search_prefix):
             mode = entry.st_mode
             if S_ISREG(mode):
                 entries.append({'Key':entry.filename,'LastModified':datetime.fromtimestamp(entry.st_mtime, timezone.utc)})
-            if len(entries) > max_results:
+            if 0 <= max_results < len(entries):
                 raise ValueError(f"Read more than {max_results} records from the path {uri_path}. Use a more specific "
                                  f"search_prefix")
 
     LOGGER.info("Found {} files.".format(entries))
     return entries
 
-def convert_URL_to_file_list(table_spec):
+def convert_URL_to_file_list(table_spec, modified_since=None, etag=None):
     url = table_spec["path"] + "/" + table_spec["pattern"]
     LOGGER.info(f"Assembled {url} as the URL to a source file.")
-    r = requests.get(url, allow_redirects=True)
-    if r:
+    headers = {}
+    if modified_since is not None:
+        # Lets the server answer 304 Not Modified when the file has not changed since the last sync
+        headers['If-Modified-Since'] = email.utils.format_datetime(modified_since.astimezone(timezone.utc), usegmt=True)
+        if etag:
+            headers['If-None-Match'] = etag
+    session = tap_spreadsheets_anywhere.transports.get_http_session()
+    r = session.head(url, allow_redirects=True, headers=headers)
+    if r.status_code != 304 and not (r and 'last-modified' in r.headers):
+        # Not every server answers HEAD requests, or sends its metadata with them
+        LOGGER.info("URL did not answer a HEAD request with a last-modified header so requesting the file.")
+        r = session.get(url, allow_redirects=True, headers=headers)
+        if r:
+            tap_spreadsheets_anywhere.transports.store_http_body(url, r.content)
+
+    if r.status_code == 304:
+        LOGGER.info(f"URL was not modified since {modified_since}.")
+        last_modified = modified_since
+        etag = r.headers.get('etag', etag)
+    elif r:
         if 'last-modified' in r.headers:
             last_modified = pytz.UTC.localize(datetime.strptime(r.headers['last-modified'], '%a, %d %b %Y %H:%M:%S %Z'))
         else:
             LOGGER.warning("URL did not return a last-modified header so using current date and time.")
             last_modified = datetime.now(tz=timezone.utc)
-
-        filename = table_spec["pattern"]
-        # TODO: logic below is disabled because we can't currently support reading filenames from Content-Disposition (Excel limitations)
-        # if 'content-disposition' in r.headers:
-        #     cd = r.headers['content-disposition']
-        #     filename = unquote(re.findall("filename.?=(.+)", cd)[0])
-        #     LOGGER.info("URL returned '" + filename + "' as the targeted filename.")
-        # else:
-        #     LOGGER.warning("URL did not return a content-disposition header so using pattern '"+table_spec["pattern"]+"' as the targeted filename.")
-
-        return [{'Key': filename, 'LastModified':last_modified}]
+        etag = r.headers.get('etag')
     else:
         raise ValueError(f"Configured URL {url} could not be read.")
 
-
-def list_files_in_ftp_server(uri, search_prefix=None):
-    parsed_uri = ftp_transport.parse_uri(uri)
-    uri_path = parsed_uri.pop('uri_path')
-    secure_conn = True if parsed_uri["scheme"] == "ftps" else False
-    ftp = ftp_transport._connect(parsed_uri['host'], parsed_uri['user'], parsed_uri['port'], parsed_uri['password'], secure_conn, transport_params={})
+    filename = table_spec["pattern"]
+    # TODO: logic below is disabled because we can't currently support reading filenames from Content-Disposition (Excel limitations)
+    # if 'content-disposition' in r.headers:
+    #     cd = r.headers['content-disposition']
+    #     filename = unquote(re.findall("filename.?=(.+)", cd)[0])
+    #     LOGGER.info("URL returned '" + filename + "' as the targeted filename.")
+    # else:
+    #     LOGGER.warning("URL did not return a content-disposition header so using pattern '"+table_spec["pattern"]+"' as the targeted filename.")
+
+    target_object = {'Key': filename, 'LastModified': last_modified}
+    if etag:
+        target_object['ETag'] = etag
+    return [target_object]
+
+
+def list_files_in_ftp_server(uri, search_prefix=None, max_listed_files=MAX_LISTED_FILES):
+    uri_path = ftp_transport.parse_uri(uri)['uri_path']
+    ftp = tap_spreadsheets_anywhere.transports.acquire_ftp_connection(uri)
     entries = []
-    max_results = 10000
+    max_results = max_listed_files
     from stat import S_ISREG
     import fnmatch
-    for row in ftp.mlsd(uri_path):
-        if search_prefix is None or fnmatch.fnmatch(entry[0],search_prefix):
+    try:
+        rows = list(ftp.mlsd(uri_path))
+    except BaseException:
+        # The connection may be in the middle of a transfer, so it is not handed to another reader
+        ftp.close()
+        raise
+    tap_spreadsheets_anywhere.transports.release_ftp_connection(uri, ftp)
+    for row in rows:
+        if search_prefix is None or fnmatch.fnmatch(row[0],search_prefix):
             if row[1]['type'] == 'file':
                 entries.append({'Key':row[0],'LastModified':datetime.strptime(row[1]['modify'], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)})
-            if len(entries) > max_results:
-                raise print(f"Read more than {max_results} records from the path {uri_path}. Use a more specific "
+            if 0 <= max_results < len(entries):
+                raise ValueError(f"Read more than {max_results} records from the path {uri_path}. Use a more specific "
                              f"search_prefix")
 
     LOGGER.info("Found {} files.".format(entries))
     return entries
 
-def raise_error(error):
-    raise error
-
-def list_files_in_local_bucket(bucket, search_prefix=None):
-    local_filenames = []
+def list_files_in_local_bucket(bucket, search_prefix=None, max_listed_files=MAX_LISTED_FILES):
     path = bucket
     if search_prefix is not None:
         path = os.path.join(bucket, search_prefix)
 
     LOGGER.info(f"Walking {path}.")
-    max_results = 10000
-    for (dirpath, dirnames, filenames) in walk(path, onerror=raise_error):
-        for filename in filenames:
-            abspath = os.path.join(dirpath,filename)
-            relpath = os.path.relpath(abspath, path)
-            local_filenames.append(relpath)
-        if len(local_filenames) > max_results:
-            raise ValueError(f"Read more than {max_results} records from the path {path}. Use a more specific "
-                             f"search_prefix")
+    files_found = 0
+    for relpath, stat_result in _scan_local_files(path):
+        files_found += 1
+        if 0 <= max_listed_files < files_found:
+            raise ValueError(f"Read more than {max_listed_files} records from the path {path}. Use a more specific "
+                             f"search_prefix or raise max_listed_files")
+        yield {'Key': relpath, 'LastModified': datetime.fromtimestamp(stat_result.st_mtime, timezone.utc)}
+
+    LOGGER.info("Found {} files.".format(files_found))
+
+
+def _scan_local_files(path):
+    """
+    Yields the relative path and stat result of every file below `path`, in the order of os.walk. Each
+    file is stat'ed once through its directory entry, and files that disappear while listing (or broken
+    symlinks) are skipped.
+    """
+    directories = [('', path)]
+    while directories:
+        relative_dir, absolute_dir = directories.pop()
+        subdirectories = []
+        with os.scandir(absolute_dir) as entries:
+            for entry in entries:
+                relpath = os.path.join(relative_dir, entry.name)
+                try:
+                    if entry.is_dir():
+                        # Like os.walk, symlinks to directories are not followed
+                        if not entry.is_symlink():
+                            subdirectories.append((relpath, entry.path))
+                        continue
+                    stat_result = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield relpath, stat_result
+        directories.extend(reversed(subdirectories))
 
-    LOGGER.info("Found {} files.".format(len(local_filenames)))
-    # for filename in local_filenames:
-    #     LOGGER.info(f"Found {filename} and {os.path.join(path, filename)} exists {os.path.exists(os.path.join(path, filename))}")
-
-    return [{'Key': filename, 'LastModified': datetime.fromtimestamp(os.path.getmtime(os.path.join(path, filename)), timezone.utc)} for
-            filename in local_filenames if os.path.exists(os.path.join(path, filename))]
 
 def list_files_in_gs_bucket(bucket, search_prefix=None):
-    gs_client = storage.Client()
+    gs_client = tap_spreadsheets_anywhere.transports.get_gcs_client()
         
     blobs = gs_client.list_blobs(bucket, prefix=search_prefix)
 
@@ -283,29 +524,46 @@ def list_files_in_gs_bucket(bucket, search_prefix=None):
     return target_objects
 
 def list_files_in_azure_bucket(container_name, search_prefix=None):
-    sas_key = os.environ['AZURE_STORAGE_CONNECTION_STRING']
-    blob_service_client = BlobServiceClient.from_connection_string(sas_key)
+    blob_service_client = tap_spreadsheets_anywhere.transports.get_azure_client()
     container_client = blob_service_client.get_container_client(container_name)
     blob_iterator = container_client.list_blobs(name_starts_with=search_prefix)
     return [{'Key': blob.name, 'LastModified': blob.last_modified} for blob in blob_iterator if blob.size > 0]
 
 
 
-def list_files_in_s3_bucket(bucket, search_prefix=None):
-    s3_client = boto3.client('s3')
-    s3_objects = []
+def list_files_in_s3_bucket(bucket, search_prefix=None, start_after=None, max_parallel_listing=1):
+    s3_client = tap_spreadsheets_anywhere.transports.get_s3_client()
+    if max_parallel_listing > 1:
+        s3_objects = _list_s3_shards(s3_client, bucket, search_prefix or '', start_after, max_parallel_listing)
+    else:
+        s3_objects = _list_s3_prefix(s3_client, bucket, search_prefix, start_after)
+
+    files_found = 0
+    for s3_object in s3_objects:
+        files_found += 1
+        yield s3_object
+
+    LOGGER.info("Found {} files.".format(files_found))
+
+
+def _compact_s3_object(s3_object):
+    return {'Key': s3_object['Key'], 'LastModified': s3_object['LastModified']}
 
+
+def _list_s3_prefix(s3_client, bucket, prefix=None, start_after=None):
     max_results = 1000
     args = {
         'Bucket': bucket,
         'MaxKeys': max_results,
     }
-    if search_prefix is not None:
-        args['Prefix'] = search_prefix
+    if prefix is not None:
+        args['Prefix'] = prefix
+    if start_after is not None:
+        args['StartAfter'] = start_after
 
     result = s3_client.list_objects_v2(**args)
     if result['KeyCount'] > 0:
-        s3_objects += result['Contents']
+        yield from map(_compact_s3_object, result['Contents'])
         next_continuation_token = result.get('NextContinuationToken')
 
         while next_continuation_token is not None:
@@ -316,12 +574,56 @@ def list_files_in_s3_bucket(bucket, search_prefix=None):
 
             result = s3_client.list_objects_v2(**continuation_args)
 
-            s3_objects += result['Contents']
+            yield from map(_compact_s3_object, result.get('Contents', []))
             next_continuation_token = result.get('NextContinuationToken')
 
-    LOGGER.info("Found {} files.".format(len(s3_objects)))
 
-    return s3_objects
+def _list_s3_level(s3_client, bucket, prefix):
+    """Lists the objects directly under a prefix and the common prefixes one '/' below it."""
+    args = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': '/'}
+    objects, prefixes = [], []
+    while True:
+        result = s3_client.list_objects_v2(**args)
+        objects += map(_compact_s3_object, result.get('Contents', []))
+        prefixes += [common_prefix['Prefix'] for common_prefix in result.get('CommonPrefixes', [])]
+        if result.get('NextContinuationToken') is None:
+            return objects, prefixes
+        args['ContinuationToken'] = result['NextContinuationToken']
+
+
+def _list_s3_shards(s3_client, bucket, prefix, start_after, max_parallel_listing, max_depth=3):
+    """
+    Splits the keys under `prefix` into shards by the common prefixes found with a '/' delimiter, going
+    up to `max_depth` levels down until there are at least as many shards as workers, and lists the shards
+    concurrently. Returns the objects in key order, as a serial listing would.
+    """
+    def after_start(key):
+        return start_after is None or key > start_after
+
+    def may_hold_keys_after_start(shard):
+        # Every key under a shard that sorts before start_after, without being a prefix of it, sorts before it too
+        return start_after is None or shard > start_after or start_after.startswith(shard)
+
+    objects = []
+    shards = [prefix]
+    with ThreadPoolExecutor(max_workers=max_parallel_listing, thread_name_prefix='s3-listing') as executor:
+        for _ in range(max_depth):
+            if len(shards) >= max_parallel_listing:
+                break
+            next_shards = []
+            for level_objects, level_prefixes in executor.map(lambda shard: _list_s3_level(s3_client, bucket, shard), shards):
+                objects += filter(lambda obj: after_start(obj['Key']), level_objects)
+                next_shards += filter(may_hold_keys_after_start, level_prefixes)
+            shards = next_shards
+            if not shards:
+                break
+
+        LOGGER.info(f"Listing {len(shards)} prefixes of s3://{bucket}/{prefix} concurrently.")
+        for shard_objects in executor.map(lambda shard: list(_list_s3_prefix(s3_client, bucket, shard, start_after)), shards):
+            objects += shard_objects
+
+    objects.sort(key=lambda obj: obj['Key'])
+    return objects
 
 
 def config_by_crawl(crawl_config):
@@ -1,15 +1,24 @@
 import smart_open
+import smart_open.compression
+import smart_open.utils
+import pyarrow.parquet as pq
 
 from codecs import StreamReader
+import tap_spreadsheets_anywhere.arrow_conversion
 import tap_spreadsheets_anywhere.csv_handler
 import tap_spreadsheets_anywhere.excel_handler
 import tap_spreadsheets_anywhere.json_handler
 import tap_spreadsheets_anywhere.jsonl_handler
+import tap_spreadsheets_anywhere.normalization
 import tap_spreadsheets_anywhere.parquet_handler
+import tap_spreadsheets_anywhere.spooling
+import tap_spreadsheets_anywhere.transports
 
-from azure.storage.blob import BlobServiceClient
+import io
 import os
 
+SCHEME_SEP = "://"
+
 
 class InvalidFormatError(Exception):
     def __init__(self, fname, message="The file was not in the expected format"):
@@ -21,32 +30,101 @@ class InvalidFormatError(Exception):
         return f'{self.name} could not be parsed: {self.message}'
 
 
-def get_streamreader(uri, universal_newlines=True, newline='', open_mode='r', encoding='utf-8'):
-    kwarg_dispatch = {
-        "azure": lambda: {
-            "transport_params": {
-                "client": BlobServiceClient.from_connection_string(
-                    os.environ['AZURE_STORAGE_CONNECTION_STRING'],
-                )
-            }
-        },
-    }
-
-    SCHEME_SEP = "://"
-    kwargs = kwarg_dispatch.get(uri.split(SCHEME_SEP, 1)[0], lambda: {})()
-
+def get_streamreader(uri, universal_newlines=True, newline='', open_mode='r', encoding='utf-8',
+                     spool_to_disk=False, spool_memory_bytes=tap_spreadsheets_anywhere.spooling.SPOOL_MEMORY_BYTES,
+                     keep_http_body=False):
+    """
+    Opens uri for reading. With `spool_to_disk`, binary streams of remote or compressed files are first
+    copied to a local temporary file, so that formats needing random access seek locally instead of
+    issuing a request per seek. With `keep_http_body`, a body downloaded while listing stays available
+    to the next open of the uri.
+    """
     # When reading in binary mode, undefine `encoding`.
     # Otherwise, `smart_open` will return a `TextIOWrapper` in `"r"` mode.
     # However, reading binary streams needs a `BufferedReader`.
     if "b" in open_mode:
         encoding = None
-    streamreader = smart_open.open(uri, open_mode, newline=newline, errors='surrogateescape', encoding=encoding, **kwargs)
+    binary = tap_spreadsheets_anywhere.transports.open_binary(uri, keep_http_body=keep_http_body)
+    if binary is not None:
+        streamreader = _wrap_binary_stream(binary, uri, newline=newline, encoding=encoding)
+    else:
+        streamreader = smart_open.open(uri, open_mode, newline=newline, errors='surrogateescape', encoding=encoding,
+                                       transport_params=tap_spreadsheets_anywhere.transports.transport_params(uri))
+
+    if spool_to_disk and "b" in open_mode and get_local_path(uri) is None:
+        return tap_spreadsheets_anywhere.spooling.spool_stream(streamreader, spool_memory_bytes)
 
     if not universal_newlines and isinstance(streamreader, StreamReader):
         return monkey_patch_streamreader(streamreader)
     return streamreader
 
 
+def _wrap_binary_stream(binary, uri, newline='', encoding=None):
+    """Decompresses and decodes a binary stream the way smart_open.open does for the streams it opens."""
+    decompressed = smart_open.compression.compression_wrapper(binary, 'rb', filename=uri.lower())
+    if encoding is None:
+        decoded = decompressed
+    else:
+        decoded = io.TextIOWrapper(decompressed, encoding=encoding, errors='surrogateescape', newline=newline)
+    if decoded is binary:
+        return binary
+    # Closing the outermost stream has to close the transport's stream too, which gzip.GzipFile does not
+    return smart_open.utils.FileLikeProxy(decoded, binary)
+
+
+def spool_to_local_file(uri, suffix=''):
+    """Copies uri to a named temporary file, which the caller removes, and returns its path."""
+    with get_streamreader(uri, newline=None, open_mode='rb') as stream:
+        return tap_spreadsheets_anywhere.spooling.spool_to_local_file(stream, suffix)
+
+
+def _spool_options(table_spec):
+    return {'spool_to_disk': table_spec.get('spool_to_disk', False),
+            'spool_memory_bytes': table_spec.get('spool_memory_bytes',
+                                                 tap_spreadsheets_anywhere.spooling.SPOOL_MEMORY_BYTES)}
+
+
+def _removing_file(iterator, path):
+    try:
+        yield from iterator
+    finally:
+        os.remove(path)
+
+
+def _closing(iterator, reader):
+    # Closing the reader as soon as the rows are read returns pooled connections, such as FTP's, to their pool
+    try:
+        yield from iterator
+    finally:
+        reader.close()
+
+
+def get_local_path(uri):
+    """
+    Returns the filesystem path behind a local, uncompressed uri, or None for any other uri.
+    """
+    if uri.startswith('file://'):
+        path = uri[len('file://'):]
+    elif SCHEME_SEP in uri:
+        return None
+    else:
+        path = uri
+    if os.path.splitext(path)[1].lower() in smart_open.compression.get_supported_extensions():
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def get_parquet_file_opener(uri):
+    """
+    Returns a function opening a new ParquetFile on uri: memory mapped for local files, and otherwise over
+    a stream that pre-buffers the coalesced column chunk ranges of each row group it reads.
+    """
+    local_path = get_local_path(uri)
+    if local_path is not None:
+        return lambda: pq.ParquetFile(local_path, memory_map=True)
+    return lambda: pq.ParquetFile(get_streamreader(uri, newline=None, open_mode='rb'), pre_buffer=True)
+
+
 def monkey_patch_streamreader(streamreader):
     streamreader.mp_newline = '\n'
     streamreader.readline = mp_readline.__get__(streamreader, StreamReader)
@@ -127,10 +205,9 @@ def mp_readline(self, size=None, keepends=False):
     return line
 
 
-def get_row_iterator(table_spec, uri):
+def detect_format(table_spec, uri):
     universal_newlines = table_spec['universal_newlines'] if 'universal_newlines' in table_spec else True
     encoding = table_spec['encoding'] if 'encoding' in table_spec else 'utf-8'
-    skip_initial = table_spec.get("skip_initial", 0)
 
     if 'format' not in table_spec or table_spec['format'] == 'detect':
         lowered_uri = uri.lower()
@@ -146,9 +223,10 @@ def get_row_iterator(table_spec, uri):
             format = 'parquet'
         else:
             # TODO: some protocols provide the ability to pull format (content-type) info & we could make use of that here
-            reader = get_streamreader(uri, universal_newlines=universal_newlines, open_mode='r', encoding=encoding)
-            buf = reader.read(10)
-            reader.seek(0)
+            # The rows are read by the next open, which can still use a body downloaded while listing
+            with get_streamreader(uri, universal_newlines=universal_newlines, open_mode='r', encoding=encoding,
+                                  keep_http_body=True) as reader:
+                buf = reader.read(10)
             if len(buf) > 0:
                 if buf[0].lstrip() == "[":
                     format = 'json'
@@ -161,7 +239,67 @@ def get_row_iterator(table_spec, uri):
 
     else:
         format = table_spec['format']
+    return format
+
+
+def get_batch_iterator(table_spec, uri, format=None):
+    """
+    Returns an iterator of Arrow record batches with normalized column names for Parquet files and
+    CSV files read by the arrow engine, or None when rows must be read through get_row_iterator. The
+    `format` of the file is detected unless it is given.
+    """
+    if format is None:
+        format = detect_format(table_spec, uri)
+    if format == 'parquet' or (format == 'csv' and table_spec.get('engine') == 'arrow'):
+        return _open_batches(table_spec, uri, format)
+    return None
+
+
+def _open_batches(table_spec, uri, format):
+    encoding = table_spec['encoding'] if 'encoding' in table_spec else 'utf-8'
+    skip_initial = table_spec.get("skip_initial", 0)
+    try:
+        if format == 'parquet' and table_spec.get('max_parallel_row_groups', 1) > 1:
+            if table_spec.get('spool_to_disk', False) and get_local_path(uri) is None:
+                # Every worker memory-maps the one local copy
+                local_path = spool_to_local_file(uri, suffix='.parquet')
+                iterator = tap_spreadsheets_anywhere.parquet_handler.get_parallel_batch_iterator(
+                    table_spec, get_parquet_file_opener(local_path))
+                return _removing_file(tap_spreadsheets_anywhere.arrow_conversion.skip_rows(iterator, skip_initial),
+                                      local_path)
+            iterator = tap_spreadsheets_anywhere.parquet_handler.get_parallel_batch_iterator(
+                table_spec, get_parquet_file_opener(uri))
+            return tap_spreadsheets_anywhere.arrow_conversion.skip_rows(iterator, skip_initial)
+
+        reader = get_streamreader(uri, newline=None, open_mode='rb', **_spool_options(table_spec))
+        try:
+            if format == 'parquet':
+                iterator = tap_spreadsheets_anywhere.parquet_handler.get_batch_iterator(table_spec, reader)
+            else:
+                iterator = tap_spreadsheets_anywhere.csv_handler.get_batch_iterator(table_spec, reader, encoding=encoding)
+        except BaseException:
+            reader.close()
+            raise
+    except (ValueError,TypeError) as err:
+        raise InvalidFormatError(uri,message=err)
+
+    return _closing(tap_spreadsheets_anywhere.arrow_conversion.skip_rows(iterator, skip_initial), reader)
+
+
+def get_row_iterator(table_spec, uri, format=None):
+    universal_newlines = table_spec['universal_newlines'] if 'universal_newlines' in table_spec else True
+    encoding = table_spec['encoding'] if 'encoding' in table_spec else 'utf-8'
+    skip_initial = table_spec.get("skip_initial", 0)
+
+    if format is None:
+        format = detect_format(table_spec, uri)
+
+    if format == 'csv' and table_spec.get('engine') == 'arrow':
+        # skip_initial is already applied to the record batches
+        batches = _open_batches(table_spec, uri, format)
+        return _closing(tap_spreadsheets_anywhere.arrow_conversion.rows_from_batches(batches), batches)
 
+    reader = None
     try:
         if format == 'csv':
             reader = get_streamreader(uri, universal_newlines=universal_newlines, open_mode='r', encoding=encoding)
@@ -172,10 +310,15 @@ def get_row_iterator(table_spec, uri):
                 iterator = tap_spreadsheets_anywhere.excel_handler.get_legacy_row_iterator(table_spec, reader)
             else:
                 # If encoding is set, smart_open will override binary mode ('b' in open_mode) and it will result in a BadZipFile error
-                reader = get_streamreader(uri, universal_newlines=universal_newlines,newline=None, open_mode='rb', encoding=None)
-                iterator = tap_spreadsheets_anywhere.excel_handler.get_row_iterator(table_spec, reader)
+                reader = get_streamreader(uri, universal_newlines=universal_newlines,newline=None, open_mode='rb', encoding=None,
+                                          **_spool_options(table_spec))
+                if table_spec.get('engine') == 'stream':
+                    iterator = tap_spreadsheets_anywhere.excel_handler.get_streaming_row_iterator(table_spec, reader)
+                else:
+                    iterator = tap_spreadsheets_anywhere.excel_handler.get_row_iterator(table_spec, reader)
         elif format == 'parquet':
-            reader = get_streamreader(uri, universal_newlines=universal_newlines, newline=None, open_mode='rb')
+            reader = get_streamreader(uri, universal_newlines=universal_newlines, newline=None, open_mode='rb',
+                                      **_spool_options(table_spec))
             iterator = tap_spreadsheets_anywhere.parquet_handler.get_row_iterator(table_spec, reader)
         elif format == 'json':
             reader = get_streamreader(uri, universal_newlines=universal_newlines, open_mode='r', encoding=encoding)
@@ -183,8 +326,14 @@ def get_row_iterator(table_spec, uri):
         elif format == 'jsonl':
             reader = get_streamreader(uri, universal_newlines=universal_newlines, open_mode='r', encoding=encoding)
             iterator = tap_spreadsheets_anywhere.jsonl_handler.get_row_iterator(table_spec, reader)
-    except (ValueError,TypeError) as err:
-        raise InvalidFormatError(uri,message=err)
+    except BaseException as err:
+        if reader is not None:
+            reader.close()
+        if isinstance(err, (ValueError, TypeError)):
+            raise InvalidFormatError(uri,message=err)
+        raise
+    if reader is not None:
+        iterator = _closing(iterator, reader)
 
     if format != 'excel':
         # Reduce the scope of changes to fix Issue #52.
@@ -192,3 +341,68 @@ def get_row_iterator(table_spec, uri):
             next(iterator)
 
     return iterator
+
+
+def get_window_row_iterators(table_spec, uri, window_count, window_bytes, format=None):
+    """
+    Returns row iterators over `window_count` windows of about `window_bytes` spread evenly over a csv or
+    jsonl file: the head of the file read as usual, followed by windows read with seeks and trimmed to whole
+    lines. Returns None when the file is no larger than the windows together or can not be read at random
+    offsets (other formats, compressed files, encodings where a newline is not the byte '\\n', unseekable
+    streams). The `format` of the file is detected unless it is given.
+    """
+    encoding = table_spec['encoding'] if 'encoding' in table_spec else 'utf-8'
+    if format is None:
+        format = detect_format(table_spec, uri)
+    if format not in ('csv', 'jsonl') or window_count < 2:
+        return None
+    if os.path.splitext(uri)[1].lower() in smart_open.compression.get_supported_extensions():
+        return None
+    if '\n'.encode(encoding) != b'\n':
+        return None
+
+    with get_streamreader(uri, newline=None, open_mode='rb', keep_http_body=True) as reader:
+        if not reader.seekable():
+            return None
+        size = reader.seek(0, io.SEEK_END)
+        if size <= window_count * window_bytes:
+            return None
+
+        header = b''
+        if format == 'csv' and 'field_names' not in table_spec:
+            reader.seek(0)
+            header = reader.readline()
+
+        texts = []
+        step = (size - window_bytes) / (window_count - 1)
+        for index in range(1, window_count):
+            reader.seek(int(index * step))
+            window = reader.read(window_bytes)
+            # Drop the partial lines at both ends of the window
+            start, end = window.find(b'\n') + 1, window.rfind(b'\n') + 1
+            if start < end:
+                texts.append(io.StringIO((header + window[start:end]).decode(encoding, errors='surrogateescape'),
+                                         newline=''))
+
+    # skip_initial only applies to the head of the file
+    window_spec = {key: value for key, value in table_spec.items() if key != 'skip_initial'}
+
+    iterators = [get_row_iterator(table_spec, uri, format)]
+    for text in texts:
+        try:
+            if format == 'csv':
+                iterators.append(_complete_rows(tap_spreadsheets_anywhere.csv_handler.get_row_iterator(window_spec, text)))
+            else:
+                iterators.append(tap_spreadsheets_anywhere.jsonl_handler.get_row_iterator(window_spec, text))
+        except (ValueError, TypeError) as err:
+            for iterator in iterators:
+                iterator.close()
+            raise InvalidFormatError(uri, message=err)
+    return iterators
+
+
+def _complete_rows(iterator):
+    # A window may start inside a quoted value holding a newline, which shows as rows of the wrong length
+    for row in iterator:
+        if tap_spreadsheets_anywhere.normalization.EXTRA_FIELDS_KEY not in row and None not in row.values():
+            yield row
@@ -1,46 +1,158 @@
+import itertools
 import json
-from jsonpath_ng.ext import parse
 import re
+from jsonpath_ng.ext import parse
 from json import JSONDecodeError
 import logging
 
+from tap_spreadsheets_anywhere.normalization import normalize_keys
+
 LOGGER = logging.getLogger(__name__)
 
+CHUNK_SIZE = 64 * 1024
+# Longest token that the end of a chunk can cut so that it fails to decode, such as -Infinity or a \uXXXX escape
+TRUNCATED_TOKEN_CHARS = 16
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# json_path values that can only name a top-level key, which is then found without decoding the values before it
+PLAIN_KEY = re.compile(r'\w+')
+
+
 def generator_wrapper(root_iterator):
     for obj in root_iterator:
-        to_return = {}
-        for key, value in obj.items():
-            if key is None:
-                key = '_smart_extra'
+        yield normalize_keys(obj)
 
-            formatted_key = key
-            # remove non-word, non-whitespace characters
-            formatted_key = re.sub(r"[^\w\s]", '', formatted_key)
-            # replace whitespace with underscores
-            formatted_key = re.sub(r"\s+", '_', formatted_key)
-            to_return[formatted_key.lower()] = value
-        yield to_return
 
+class JSONStream():
+    """
+    Incrementally decodes JSON from a text stream. Only the value being decoded and the unread part of the
+    last chunk are held in memory.
+    """
 
-def get_row_iterator(table_spec, reader):
+    def __init__(self, reader, chunk_size=CHUNK_SIZE):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        data = self.reader.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it, or '' at the end of the stream."""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(self.chunk_size):
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending with the buffer may be a truncated number, so only trust it at the end of the stream
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except JSONDecodeError as err:
+                # Reading more only helps a value cut off by the end of the buffer. Errors further back, other
+                # than in a string still being read, are in the data itself.
+                if self.eof or (err.pos < len(self.buffer) - TRUNCATED_TOKEN_CHARS and
+                                not err.msg.startswith('Unterminated string')):
+                    raise
+            # Grow the read with the pending value so that very large values are not re-parsed chunk by chunk
+            self._fill(max(self.chunk_size, len(self.buffer) - self.pos))
+
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            delimiter = self.peek()
+            self.pos += 1
+            if delimiter == ']':
+                return
+            if delimiter != ',':
+                raise JSONDecodeError("Expecting ',' delimiter", self.buffer, self.pos - 1)
+
+    def iter_values(self):
+        while self.peek():
+            yield self.decode()
+
+    def find_key(self, key):
+        """Positions the stream on the value of `key` in the object being read, skipping the values before it."""
+        self.expect('{')
+        if self.peek() == '}':
+            return False
+        while True:
+            current_key = self.decode()
+            self.expect(':')
+            if current_key == key:
+                return True
+            self.decode()
+            delimiter = self.peek()
+            self.pos += 1
+            if delimiter == '}':
+                return False
+            if delimiter != ',':
+                raise JSONDecodeError("Expecting ',' delimiter", self.buffer, self.pos - 1)
+
+
+def iter_array_document(stream):
+    yield from stream.iter_array()
+    if stream.peek():
+        raise JSONDecodeError("Extra data", stream.buffer, stream.pos)
+
+
+def primed(iterator):
+    """Decodes the first element right away so that unparseable files fail when they are opened."""
     try:
-        json_array = json.load(reader)
-        json_path = table_spec.get('json_path', None)
-
-        if json_path is not None:
-            if json_path in json_array:
-                json_array = json_array[json_path]
-            else:
-                return generator_wrapper(match.value for match in parse(json_path).find(json_array))
-
-        # throw a TypeError if the root json object can not be iterated
-        return generator_wrapper(iter(json_array))
-    except JSONDecodeError as jde:
-        if jde.msg.startswith("Extra data"):
-            reader.seek(0)
-            json_objects = []
-            for jobj in reader:
-                json_objects.append(json.loads(jobj))
-            return generator_wrapper(json_objects)
-        else:
-            raise jde
+        first = next(iterator)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], iterator)
+
+
+def get_row_iterator(table_spec, reader):
+    stream = JSONStream(reader)
+    json_path = table_spec.get('json_path', None)
+    first_char = stream.peek()
+
+    if json_path is not None:
+        if first_char == '{' and PLAIN_KEY.fullmatch(json_path):
+            if not stream.find_key(json_path):
+                # As a JSONPath expression, a plain key only matches a top-level key
+                return generator_wrapper(iter(()))
+            if stream.peek() == '[':
+                return generator_wrapper(primed(stream.iter_array()))
+            # throw a TypeError if the value can not be iterated
+            return generator_wrapper(iter(stream.decode()))
+        json_array = stream.decode()
+        if json_path in json_array:
+            return generator_wrapper(iter(json_array[json_path]))
+        return generator_wrapper(match.value for match in parse(json_path).find(json_array))
+
+    if first_char == '[':
+        return generator_wrapper(primed(iter_array_document(stream)))
+    if first_char == '{':
+        # One or more concatenated objects, e.g. one object per line
+        return generator_wrapper(primed(stream.iter_values()))
+
+    # throw a TypeError if the root json value can not be iterated
+    return generator_wrapper(iter(stream.decode()))
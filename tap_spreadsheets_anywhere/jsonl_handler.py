@@ -1,40 +1,41 @@
+import itertools
 import json
-import re
-from json import JSONDecodeError
 import logging
 
+from tap_spreadsheets_anywhere.normalization import normalize_keys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LOGGER = logging.getLogger(__name__)
 
-def generator_wrapper(root_iterator):
-    for obj in root_iterator:
-        json_obj = json.loads(obj)
-        to_return = {}
-        for key, value in json_obj.items():
-            if key is None:
-                key = '_smart_extra'
+BATCH_SIZE = 1000
 
-            formatted_key = key
-            # remove non-word, non-whitespace characters
-            formatted_key = re.sub(r"[^\w\s]", '', formatted_key)
-            # replace whitespace with underscores
-            formatted_key = re.sub(r"\s+", '_', formatted_key)
-            to_return[formatted_key.lower()] = value
-        yield to_return
 
+def loads(line):
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # The standard library also accepts NaN, Infinity and integers wider than 64 bits
+            pass
+    return json.loads(line)
 
-def get_row_iterator(table_spec, reader):
-    try:
-        return generator_wrapper(iter(reader))
-    except JSONDecodeError as jde:
-        if jde.msg.startswith("Extra data"):
-            reader.seek(0)
-            json_objects = []
-            for jobj in reader:
-                json_objects.append(json.loads(jobj))
-            return generator_wrapper(json_objects)
-        else:
-            raise jde
 
+def decode_batch(lines):
+    return [loads(line) for line in lines if line and not line.isspace()]
 
 
+def generator_wrapper(root_iterator, batch_size=BATCH_SIZE):
+    while True:
+        lines = list(itertools.islice(root_iterator, batch_size))
+        if not lines:
+            return
+        for json_obj in decode_batch(lines):
+            yield normalize_keys(json_obj)
 
+
+def get_row_iterator(table_spec, reader):
+    return generator_wrapper(iter(reader))
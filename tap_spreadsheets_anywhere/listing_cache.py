@@ -0,0 +1,131 @@
+'''Reuses object listings within a run and, optionally, across runs through on-disk listing manifests'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+LOGGER = logging.getLogger(__name__)
+
+# Protocols whose listings are returned in lexical key order and can resume after a given key
+INCREMENTAL_PROTOCOLS = ('s3',)
+
+
+def cache_key(table_spec):
+    return table_spec['path'], table_spec.get('search_prefix'), table_spec['pattern']
+
+
+class ListingCache():
+    """
+    Holds the pattern-matched objects of every (path, search_prefix, pattern) listed during a run. When a
+    `cache_dir` is given, each listing is also written to a manifest there. A manifest younger than `max_age`
+    seconds is reused without listing, and tables with `incremental_listing` on a protocol that supports it
+    only list the keys that sort after the last key of their manifest.
+    """
+
+    def __init__(self, cache_dir=None, max_age=0):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.listings = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, table_spec, list_objects):
+        key = cache_key(table_spec)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.listings:
+                self.listings[key] = self._load_or_list(table_spec, key, list_objects)
+            else:
+                LOGGER.info(f'Reusing the listing of {len(self.listings[key])} objects matching "{table_spec["pattern"]}".')
+            return self.listings[key]
+
+    def _load_or_list(self, table_spec, key, list_objects):
+        manifest = self._read_manifest(key) if self.cache_dir else None
+        if manifest is not None and time.time() - manifest['listed_at'] <= self.max_age:
+            LOGGER.info(f'Reusing the listing manifest of {len(manifest["objects"])} objects matching "{table_spec["pattern"]}".')
+            return manifest['objects']
+
+        objects = []
+        start_after = None
+        protocol = table_spec['path'].split('://', 1)[0]
+        if manifest is not None and table_spec.get('incremental_listing', False) and protocol in INCREMENTAL_PROTOCOLS:
+            objects = manifest['objects']
+            start_after = manifest['last_key']
+            LOGGER.info(f'Listing objects after "{start_after}" to refresh a manifest of {len(objects)} objects.')
+
+        listed_at = time.time()
+        new_objects, last_key = list_objects(table_spec, start_after)
+        objects = objects + new_objects
+        if self.cache_dir:
+            self._write_manifest(key, objects, last_key or start_after, listed_at)
+        return objects
+
+    def _manifest_path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'listing-{digest}.json')
+
+    def _read_manifest(self, key):
+        try:
+            with open(self._manifest_path(key)) as fp:
+                manifest = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            LOGGER.warning(f'Ignoring unreadable listing manifest {self._manifest_path(key)}.')
+            return None
+        manifest['objects'] = [_object_from_manifest(*entry) for entry in manifest['objects']]
+        return manifest
+
+    def _write_manifest(self, key, objects, last_key, listed_at):
+        manifest = {
+            'listed_at': listed_at,
+            'last_key': last_key,
+            'objects': [[obj['key'], obj['last_modified'].isoformat()] + ([obj['etag']] if 'etag' in obj else [])
+                        for obj in objects],
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Written to a temporary file first so that an interrupted run never leaves a truncated manifest
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(manifest, fp)
+            os.replace(tmp_path, self._manifest_path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def _object_from_manifest(key, last_modified, etag=None):
+    obj = {'key': key, 'last_modified': datetime.fromisoformat(last_modified)}
+    if etag is not None:
+        obj['etag'] = etag
+    return obj
+
+
+_CACHE = None
+
+
+def configure(config):
+    """Shares object listings between every later discover and sync call of this process."""
+    global _CACHE
+    _CACHE = ListingCache(config.get('listing_cache_dir'), config.get('listing_cache_max_age', 0))
+
+
+def reset():
+    global _CACHE
+    _CACHE = None
+
+
+def get_listing(table_spec, list_objects):
+    """
+    Returns the objects of a table that match its pattern, listed with `list_objects(table_spec, start_after)`
+    unless the listings of this process are cached and already hold them.
+    """
+    if _CACHE is None:
+        return list_objects(table_spec, None)[0]
+    return _CACHE.get(table_spec, list_objects)
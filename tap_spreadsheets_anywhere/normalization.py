@@ -0,0 +1,30 @@
+import re
+from functools import lru_cache
+
+NON_WORD_PATTERN = re.compile(r"[^\w\s]")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+EXTRA_FIELDS_KEY = '_smart_extra'
+
+
+@lru_cache(maxsize=4096)
+def normalize_key(key):
+    """
+    Maps a raw column name or object key onto the name used in the stream's schema:
+    non-word, non-whitespace characters are removed, whitespace runs become underscores
+    and the result is lowercased.
+    """
+    if key is None:
+        return EXTRA_FIELDS_KEY
+    # remove non-word, non-whitespace characters
+    formatted_key = NON_WORD_PATTERN.sub('', key)
+    # replace whitespace with underscores
+    formatted_key = WHITESPACE_PATTERN.sub('_', formatted_key)
+    return formatted_key.lower()
+
+
+def normalize_header(header):
+    return [normalize_key(key) for key in header]
+
+
+def normalize_keys(obj):
+    return {normalize_key(key): value for key, value in obj.items()}
@@ -0,0 +1,95 @@
+'''Serializes the Singer messages of concurrently synced streams onto stdout'''
+import logging
+import sys
+import threading
+import time
+
+import singer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LOGGER = logging.getLogger(__name__)
+
+BUFFER_BYTES = 1024 * 1024
+FLUSH_SECONDS = 1.0
+
+
+def format_message(message):
+    if orjson is not None:
+        # Records hold no NaN or infinities, which orjson would write as null: conversion rejects them
+        try:
+            return orjson.dumps(message.asdict()).decode('utf-8')
+        except TypeError:
+            # e.g. Decimal values, which singer's encoder supports
+            pass
+    return singer.format_message(message)
+
+
+class BufferedMessageWriter():
+    """
+    Collects serialized messages in one buffer and writes them to stdout when the buffer grows past
+    `buffer_bytes`, when `flush_seconds` have passed since the last write, or when flush() is called.
+    Messages are written in the order they were handed over.
+    """
+
+    def __init__(self, buffer_bytes=BUFFER_BYTES, flush_seconds=FLUSH_SECONDS):
+        self.buffer_bytes = buffer_bytes
+        self.flush_seconds = flush_seconds
+        self.lock = threading.RLock()
+        self.lines = []
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, message, flush=False):
+        line = format_message(message) + '\n'
+        with self.lock:
+            self.lines.append(line)
+            self.buffered += len(line)
+            if flush or self.buffered >= self.buffer_bytes or \
+                    time.monotonic() - self.last_flush >= self.flush_seconds:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.lines:
+                lines = ''.join(self.lines)
+                self.lines = []
+                self.buffered = 0
+                sys.stdout.write(lines)
+            sys.stdout.flush()
+            self.last_flush = time.monotonic()
+
+
+_WRITER = BufferedMessageWriter()
+
+
+def configure(config):
+    _WRITER.buffer_bytes = config.get('output_buffer_bytes', BUFFER_BYTES)
+    _WRITER.flush_seconds = config.get('output_flush_seconds', FLUSH_SECONDS)
+
+
+def write_schema(stream_name, schema, key_properties):
+    if isinstance(key_properties, (str, bytes)):
+        key_properties = [key_properties]
+    _WRITER.write(singer.SchemaMessage(stream=stream_name, schema=schema, key_properties=key_properties))
+
+
+def write_record(stream_name, record):
+    _WRITER.write(singer.RecordMessage(stream=stream_name, record=record))
+
+
+def write_bookmark(state, stream_name, bookmark):
+    """
+    Records one stream's bookmark in the state shared by all streams and writes the merged state, so that
+    every STATE message holds the latest bookmark of each stream. STATE messages are flushed right away.
+    """
+    with _WRITER.lock:
+        state[stream_name] = bookmark
+        _WRITER.write(singer.StateMessage(value=state), flush=True)
+
+
+def flush():
+    _WRITER.flush()
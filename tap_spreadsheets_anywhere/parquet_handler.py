@@ -1,31 +1,79 @@
-import re
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
 import pyarrow.parquet as pq
 
-LOGGER = logging.getLogger(__name__)
+from tap_spreadsheets_anywhere.arrow_conversion import rows_from_batches
+from tap_spreadsheets_anywhere.normalization import normalize_header
 
+LOGGER = logging.getLogger(__name__)
 
-def generator_wrapper(table, _={}) -> dict:
-    # change column name
-    def format_name(name=""):
-        formatted_key = re.sub(r"[^\w\s]", "", name)
-        # replace whitespace with underscores
-        formatted_key = re.sub(r"\s+", "_", formatted_key)
-        return formatted_key.lower()
 
-    table = table.rename_columns([format_name(name) for name in table.column_names])
+def get_batch_iterator(table_spec, file_handle):
+    try:
+        parquet_file = pq.ParquetFile(file_handle)
+    except Exception as e:
+        LOGGER.error("Unable to read the Parquet file: %s", e)
+        raise e
 
-    for row in table.to_pylist():
-        yield row
+    # The normalized column names only depend on the file's schema
+    names = normalize_header(parquet_file.schema_arrow.names)
+    for batch in parquet_file.iter_batches():
+        yield pa.RecordBatch.from_arrays(batch.columns, names=names)
 
 
 def get_row_iterator(table_spec, file_handle):
+    return rows_from_batches(get_batch_iterator(table_spec, file_handle))
+
+
+def get_parallel_batch_iterator(table_spec, open_parquet_file):
+    """
+    Decodes row groups concurrently and yields their batches in file order. Each worker thread reads
+    through its own ParquetFile from `open_parquet_file()`, and at most `max_parallel_row_groups` decoded
+    row groups are held at once. Every ParquetFile is closed once the batches are read or the iterator is
+    closed.
+    """
+    max_workers = table_spec.get('max_parallel_row_groups', 1)
     try:
-        parquet_file = pq.ParquetFile(file_handle)
+        parquet_file = open_parquet_file()
     except Exception as e:
         LOGGER.error("Unable to read the Parquet file: %s", e)
         raise e
 
-    # Use batch to read the Parquet file
-    for batch in parquet_file.iter_batches():
-        yield from generator_wrapper(batch, table_spec)
+    opened_files = [parquet_file]
+    opened_files_lock = threading.Lock()
+    names = normalize_header(parquet_file.schema_arrow.names)
+    num_row_groups = parquet_file.num_row_groups
+    worker_state = threading.local()
+
+    def read_row_group(index):
+        if not hasattr(worker_state, 'parquet_file'):
+            worker_state.parquet_file = open_parquet_file()
+            with opened_files_lock:
+                opened_files.append(worker_state.parquet_file)
+        return worker_state.parquet_file.read_row_group(index, use_threads=False)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='parquet-row-group')
+    pending = deque()
+    try:
+        for index in range(num_row_groups):
+            pending.append(executor.submit(read_row_group, index))
+            if len(pending) >= max_workers:
+                yield from _renamed_batches(pending.popleft().result(), names)
+        while pending:
+            yield from _renamed_batches(pending.popleft().result(), names)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        # Closed after the workers stopped, and before a spooled copy of the file is removed
+        for opened_file in opened_files:
+            opened_file.close(force=True)
+
+
+def _renamed_batches(table, names):
+    for batch in table.to_batches():
+        yield pa.RecordBatch.from_arrays(batch.columns, names=names)
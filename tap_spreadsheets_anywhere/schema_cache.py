@@ -0,0 +1,85 @@
+'''Keeps the type histograms of sampled files on disk so that discovery only samples new or changed files'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+LOGGER = logging.getLogger(__name__)
+
+# Changed whenever the way samples are read or typed changes, so that histograms of earlier versions are not reused
+HISTOGRAM_VERSION = 1
+# Table options that do not change which records are read from a file, nor how they are typed
+IGNORED_TABLE_OPTIONS = ('name', 'pattern', 'search_prefix', 'start_date', 'key_properties', 'selected',
+                         'schema_overrides', 'prefer_number_vs_integer', 'prefer_schema_as_string',
+                         'max_sampled_files', 'max_records_per_run', 'max_parallel_files', 'max_parallel_listing',
+                         'max_parallel_row_groups', 'max_listed_files', 'incremental_listing', 'spool_to_disk',
+                         'spool_memory_bytes')
+
+
+def fingerprint(table_spec, target_file, sample_rate, max_records):
+    """
+    Identifies the samples of one version of a file: its key, modification time and ETag when the listing
+    provides one, together with every table option and sampling parameter that shapes its samples, and the
+    version of the histograms.
+    """
+    read_options = {key: value for key, value in table_spec.items() if key not in IGNORED_TABLE_OPTIONS}
+    identity = [HISTOGRAM_VERSION, read_options, target_file['key'], target_file['last_modified'].isoformat(),
+                target_file.get('etag'), sample_rate, max_records]
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class SchemaCache():
+    """Stores one histogram file per fingerprint in `cache_dir`."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get(self, table_spec, target_file, sample_rate, max_records, count_file):
+        path = os.path.join(self.cache_dir, f'histogram-{fingerprint(table_spec, target_file, sample_rate, max_records)}.json')
+        try:
+            with open(path) as fp:
+                counts = json.load(fp)
+            LOGGER.info(f'Reusing the type histogram of {target_file["key"]}.')
+            return counts
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            LOGGER.warning(f'Ignoring unreadable type histogram {path}.')
+
+        counts = count_file()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Written to a temporary file first so that an interrupted run never leaves a truncated histogram
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(counts, fp)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return counts
+
+
+_CACHE = None
+
+
+def configure(config):
+    global _CACHE
+    cache_dir = config.get('schema_cache_dir')
+    _CACHE = SchemaCache(cache_dir) if cache_dir else None
+
+
+def reset():
+    global _CACHE
+    _CACHE = None
+
+
+def get_counts(table_spec, target_file, sample_rate, max_records, count_file):
+    """
+    Returns the type histograms of a file's samples, computed with `count_file()` unless a histogram of the
+    same version of the file, sampled the same way, is cached.
+    """
+    if _CACHE is None:
+        return count_file()
+    return _CACHE.get(table_spec, target_file, sample_rate, max_records, count_file)
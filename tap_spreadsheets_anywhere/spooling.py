@@ -0,0 +1,38 @@
+'''Copies files with large sequential reads to temporary files that formats needing random access can seek in'''
+import os
+import shutil
+import tempfile
+
+# How much of a spooled file is kept in memory before it spills to a temporary file on disk
+SPOOL_MEMORY_BYTES = 16 * 1024 * 1024
+# Size of the sequential reads that copy a file to a temporary file
+SPOOL_READ_BYTES = 8 * 1024 * 1024
+
+
+def spool_stream(stream, memory_bytes=SPOOL_MEMORY_BYTES):
+    """
+    Copies a stream into a temporary file, held in memory up to `memory_bytes`, and returns that file
+    positioned at its start. The stream is closed once copied and the temporary file is deleted when it is
+    closed.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=memory_bytes)
+    try:
+        with stream:
+            shutil.copyfileobj(stream, spool, SPOOL_READ_BYTES)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def spool_to_local_file(stream, suffix=''):
+    """Copies a stream to a named temporary file, which the caller removes, and returns its path."""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as spool:
+        try:
+            shutil.copyfileobj(stream, spool, SPOOL_READ_BYTES)
+        except BaseException:
+            spool.close()
+            os.remove(spool.name)
+            raise
+    return spool.name
@@ -0,0 +1,72 @@
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from tap_spreadsheets_anywhere import file_utils, format_handler
+
+SCHEMA = {
+    'properties': {
+        'id': {'type': ['null', 'integer']},
+        'cost': {'type': ['null', 'number']},
+        'name': {'type': ['null', 'string']},
+        'created': {'type': ['null', 'date-time']},
+        'code': {'type': ['null', 'integer']},
+    }
+}
+
+CSV_CONTENT = ('Id;Cost;Name;Created;Code;Notes\n'
+               '1;1.25;\'Connor; Jr\';2017-01-01;+7;\n'
+               '2;;Sam;2017-01-02T01:01;0x10;multi\n'
+               '3;1e3;\'Ren\xe9e\nOn two lines\';;١٢;\n'
+               '\n'
+               '4;-.5; ;not a date;99999999999999999999;x\n')
+
+
+class TestArrowCsvEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.uri = str(Path(self.tmpdir.name) / 'sample.csv')
+        Path(self.uri).write_bytes(CSV_CONTENT.encode('utf-8'))
+        self.table_spec = {'format': 'csv', 'delimiter': ';', 'quotechar': "'"}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def assert_engines_agree(self, table_spec):
+        python_rows = list(format_handler.get_row_iterator(table_spec, self.uri))
+        arrow_spec = {**table_spec, 'engine': 'arrow'}
+        arrow_rows = list(format_handler.get_row_iterator(arrow_spec, self.uri))
+        self.assertEqual(python_rows, arrow_rows)
+
+        python_records = list(file_utils.read_records(table_spec, self.uri, SCHEMA))
+        arrow_records = list(file_utils.read_records(arrow_spec, self.uri, SCHEMA))
+        self.assertEqual(python_records, arrow_records)
+        return arrow_records
+
+    def test_same_records_as_python_engine(self):
+        records = self.assert_engines_agree(self.table_spec)
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[0], {'id': 1, 'cost': 1.25, 'name': 'Connor; Jr',
+                                      'created': '2017-01-01T00:00:00+00:00', 'code': 7, 'notes': None})
+        self.assertEqual(records[1]['code'], '0x10')
+        self.assertEqual(records[2]['code'], 12)
+
+    def test_skip_initial_and_field_names(self):
+        self.assert_engines_agree({**self.table_spec, 'skip_initial': 2})
+        self.assert_engines_agree({**self.table_spec,
+                                   'field_names': ['id', 'cost', 'name', 'created', 'code', 'notes']})
+
+    def test_encoding_and_detected_delimiter(self):
+        Path(self.uri).write_bytes('id|name|cost\n1|Ren\xe9e|2.5\n2|Zo\xeb|3\n'.encode('latin-1'))
+        records = self.assert_engines_agree({'format': 'csv', 'encoding': 'latin-1', 'delimiter': 'detect'})
+        self.assertEqual(records[1], {'id': 2, 'name': 'Zo\xeb', 'cost': 3.0})
+
+    def test_delimiter_detected_when_unset(self):
+        Path(self.uri).write_bytes(b'id\tname\tcost\n1\tfirst, of many\t2.5\n2\tsecond\t3\n')
+        records = self.assert_engines_agree({'format': 'csv'})
+        self.assertEqual(records[0], {'id': 1, 'name': 'first, of many', 'cost': 2.5})
+
+    def test_empty_file(self):
+        Path(self.uri).write_bytes(b'')
+        self.assertEqual(list(format_handler.get_row_iterator({**self.table_spec, 'engine': 'arrow'}, self.uri)), [])
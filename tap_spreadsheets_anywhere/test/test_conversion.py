@@ -1,7 +1,7 @@
 import unittest
 
 from tap_spreadsheets_anywhere.conversion import convert, count_sample, count_samples, \
-    pick_datatype, generate_schema
+    pick_datatype, generate_schema, convert_row, compile_row_converter, merge_counts
 
 
 class TestConverter(unittest.TestCase):
@@ -105,3 +105,102 @@ class TestConverter(unittest.TestCase):
                              {'id': '2', 'obj': { 'date': '2017-01-01', 'count': 0 }}]),
             {'id': {'type': ['null', 'integer'],},
              'obj': {'type': ['null', 'object'],}})
+
+    def test_compiled_row_converter(self):
+        schema = {'properties': {
+            'id': {'type': ['null', 'integer']},
+            'cost': {'type': ['null', 'number']},
+            'name': {'type': ['null', 'string']},
+            'created': {'type': ['null', 'date-time']},
+            'obj': {'type': ['null', 'object']},
+            'code': {'type': 'integer'},
+        }}
+        rows = [
+            {'id': '1', 'cost': '1.25', 'name': 'Connor', 'created': '2017-01-01', 'obj': {'k': 'v'},
+             'code': '007', 'extra': 5},
+            {'id': '1.5', 'cost': 'n/a', 'name': ' ', 'created': 'not a date', 'obj': 'text',
+             'code': '', 'extra': None},
+        ]
+        converter = compile_row_converter(schema)
+        for row in rows:
+            self.assertEqual(converter(row), convert_row(row, schema))
+        self.assertEqual(
+            converter(rows[0]),
+            {'id': 1, 'cost': 1.25, 'name': 'Connor', 'created': '2017-01-01T00:00:00+00:00',
+             'obj': {'k': 'v'}, 'code': 7, 'extra': '5'})
+        self.assertEqual(
+            converter(rows[1]),
+            {'id': '1.5', 'cost': 'n/a', 'name': None, 'created': 'not a date', 'obj': 'text',
+             'code': None, 'extra': None})
+
+    def test_non_finite_floats_are_rejected(self):
+        schema = {'properties': {'cost': {'type': ['null', 'number']}, 'obj': {'type': ['null', 'object']}}}
+        converter = compile_row_converter(schema)
+        for row in ({'cost': 'nan'}, {'cost': '1e999'}, {'obj': {'values': [1.5, float('-inf')]}}):
+            with self.assertRaises(ValueError):
+                converter(row)
+        # Undeclared columns are text, as singer would write them
+        self.assertEqual(converter({'extra': float('nan')}), {'extra': 'nan'})
+
+
+class TestColumnCounts(unittest.TestCase):
+
+    def test_matches_per_cell_counts(self):
+        values = ['1', '-17', '+5', '-+5', '00012', '1.5', '.5', '5.', '1e5', '1E-3', '-.5e+2', ' 7 ', '1_000',
+                  '1_0.5', 'nan', ' -Infinity', 'INF', 'e', '.', '+', '', '   ', '\t', '\x1c', '5\n', 'Connor',
+                  '4 o clock', '0x10', '١٢', '²', 'café', ' 12', '12 ', 'a\udce9', 'None',
+                  5, 0, True, False, 1.5, 2.0, float('nan'), None, {'k': 'v'}, ['a'], '2017-01-01']
+        import random
+        rng = random.Random(7)
+        samples = []
+        for _ in range(300):
+            samples.append({'mixed': rng.choice(values), 'mostly_int': rng.choice(['1', '22', '-3', rng.choice(values)]),
+                            'text': rng.choice(['a', 'b c', 'café'])})
+        expected = {}
+        for sample in samples:
+            expected = count_sample(sample, expected)
+
+        counts = count_samples(samples)
+        self.assertEqual(counts, expected)
+        self.assertEqual(list(counts), list(expected))
+        for key in counts:
+            self.assertEqual(list(counts[key].items()), list(expected[key].items()))
+            self.assertEqual(pick_datatype(counts[key]), pick_datatype(expected[key]))
+        for value in values:
+            self.assertEqual(count_samples([{'v': value}]), count_sample({'v': value}), repr(value))
+
+    def test_merged_counts_match_counts_of_concatenated_samples(self):
+        samples = [{'a': '1'}, {'a': 'x', 'b': '2017-01-01'}, {'c': 1.5}, {'a': '2.5', 'b': ''}, {'b': '3'}, {'a': 'y'}]
+        expected = count_samples(samples)
+        merged = merge_counts([count_samples(samples[:2]), count_samples(samples[2:3]), count_samples(samples[3:])])
+        self.assertEqual(list(merged.items()), list(expected.items()))
+        for key in expected:
+            self.assertEqual(list(merged[key].items()), list(expected[key].items()))
+
+
+class TestDateTimeCoercion(unittest.TestCase):
+
+    VALUES = ['2020-01-01', '2020-01-01T10:00:00Z', '2020-01-01 10:00:00+0530', '2020-01-01T10:00:00.5',
+              '2020-01-01T10:00:00.123456-07:00', '2020-01-01T10:00', '2020-02-30', '2020-01-01T24:00:00',
+              '2020-01-01T10:00:00+25:00', '2020-01-01T10:00:00.1234567', '20200101', ' 2020-01-01',
+              '1 Jan 2020', '01-jan-2020', '2020/1/2', '1/2/2020 3:04', '12/31/1999 23:59:59', '13/04/2020',
+              '04/13/2020', '1/2/20', 'Jan 1 2020', '31 Feb 2020', 'soon', 5, 1.5]
+
+    def test_matches_dateutil_coercion(self):
+        import random
+        from tap_spreadsheets_anywhere.conversion import _convert_date_time, get_coercer
+        rng = random.Random(3)
+        for _ in range(100):
+            coercer = get_coercer(['null', 'date-time'])
+            for value in (rng.choice(self.VALUES) for _ in range(50)):
+                self.assertEqual(coercer(value), _convert_date_time(value), repr(value))
+
+    def test_learned_format_skips_dateutil(self):
+        from unittest.mock import patch
+        from tap_spreadsheets_anywhere.conversion import get_coercer
+        import dateutil.parser
+        coercer = get_coercer(['null', 'date-time'])
+        with patch('dateutil.parser.parse', wraps=dateutil.parser.parse) as parse:
+            self.assertEqual([coercer(value) for value in ['3/4/2021', '12/25/2021', '1/2/2022 10:30']],
+                             ['2021-03-04T00:00:00+00:00', '2021-12-25T00:00:00+00:00', '2022-01-02T10:30:00+00:00'])
+            self.assertEqual(parse.call_count, 2)
@@ -1,7 +1,13 @@
+import io
 import logging
+import os
+import struct
+from unittest.mock import patch
+
 import pytest
+import xlrd
 from openpyxl import Workbook
-from tap_spreadsheets_anywhere.excel_handler import generator_wrapper
+from tap_spreadsheets_anywhere.excel_handler import generator_wrapper, get_legacy_row_iterator
 
 LOGGER = logging.getLogger(__name__)
 
@@ -27,6 +33,39 @@ def get_worksheet():
     return ws, wb, tree_data, exp_tree_data
 
 
+def biff_record(code, data=b''):
+    return struct.pack('<HH', code, len(data)) + data
+
+
+def get_legacy_workbook(sheets):
+    """Build a minimal BIFF8 workbook stream, which xlrd reads like an .xls file, from (name, rows) pairs."""
+    def sheet_stream(rows):
+        stream = biff_record(0x0809, struct.pack('<HHHHII', 0x0600, 0x0010, 0, 0, 0, 0))
+        stream += biff_record(0x0200, struct.pack('<iiHHH', 0, len(rows), 0, max(len(row) for row in rows), 0))
+        for rowx, row in enumerate(rows):
+            for colx, value in enumerate(row):
+                if isinstance(value, str):
+                    stream += biff_record(0x0204, struct.pack('<HHHHB', rowx, colx, 0, len(value), 0) + value.encode('latin-1'))
+                else:
+                    stream += biff_record(0x0203, struct.pack('<HHHd', rowx, colx, 0, value))
+        return stream + biff_record(0x000A)
+
+    def globals_stream(positions):
+        stream = biff_record(0x0809, struct.pack('<HHHHII', 0x0600, 0x0005, 0, 0, 0, 0))
+        stream += biff_record(0x00E0, struct.pack('<HHHBBBBIIH', 0, 0, 0xFFF5, 0x20, 0, 0, 0, 0, 0, 0x20C0)) * 16
+        for (name, _), position in zip(sheets, positions):
+            stream += biff_record(0x0085, struct.pack('<IBBBB', position, 0, 0, len(name), 0) + name.encode('latin-1'))
+        return stream + biff_record(0x000A)
+
+    streams = [sheet_stream(rows) for _, rows in sheets]
+    position = len(globals_stream([0] * len(sheets)))
+    positions = []
+    for stream in streams:
+        positions.append(position)
+        position += len(stream)
+    return globals_stream(positions) + b''.join(streams)
+
+
 class TestExcelHandlerGeneratorWrapper:
     """Validate the expected state of the `excel_handler.generator_wrapper`."""
     def test_parse_data(self):
@@ -37,3 +76,171 @@ class TestExcelHandlerGeneratorWrapper:
         assert next(_generator) == exp[2]
         with pytest.raises(StopIteration):
             next(_generator)
+
+
+class TestStreamingEngine:
+    """Validate that the `stream` engine reads the same rows as openpyxl."""
+
+    def write_workbook(self, path):
+        import datetime
+        wb = Workbook()
+        small = wb.active
+        small.title = "Small"
+        small.append(["Only", "Header"])
+        data = wb.create_sheet("Data")
+        data.append(["Id", "Name", "When", "Time", "Duration", "Amount", "Flag"])
+        for row in range(40):
+            data.append([row, f"name {row % 7}", datetime.datetime(2021, 3, 1, 12) + datetime.timedelta(days=row),
+                         datetime.time(row % 24, 30), datetime.timedelta(hours=row), row * 1.25, row % 3 == 0])
+        data["C5"].number_format = "yyyy-mm-dd h:mm"
+        data["E6"].number_format = "[h]:mm:ss"
+        data.append([])
+        data.cell(row=45, column=2, value="sparse")
+        data.cell(row=46, column=9, value="wider than the header")
+        wb.save(path)
+
+    def read(self, table_spec, uri):
+        from tap_spreadsheets_anywhere.format_handler import get_row_iterator
+        return list(get_row_iterator(table_spec, uri))
+
+    def test_matches_openpyxl_rows(self, tmpdir):
+        xlsx = tmpdir / "types.xlsx"
+        self.write_workbook(xlsx)
+        for table_spec, row_count in [({"format": "excel"}, 45), ({"format": "excel", "worksheet_name": "Data"}, 45),
+                                      ({"format": "excel", "worksheet_name": "Data", "skip_initial": 3}, 42),
+                                      ({"format": "excel", "worksheet_name": "Small"}, 0)]:
+            expected = self.read(table_spec, f"file://{xlsx}")
+            assert len(expected) == row_count
+            assert self.read(dict(table_spec, engine="stream"), f"file://{xlsx}") == expected
+
+    def test_shared_strings_table(self):
+        from tap_spreadsheets_anywhere.excel_handler import SharedStrings, SHARED_STRINGS_CHUNK
+        strings = [f"value {index}" * (index % 3) for index in range(SHARED_STRINGS_CHUNK * 2 + 5)]
+        table = SharedStrings(iter(strings))
+        assert len(table) == len(strings)
+        assert [table[index] for index in range(len(strings))] == strings
+        with pytest.raises(IndexError):
+            table[len(strings)]
+
+
+class TestWorksheetSelection:
+    """Validate how worksheets are chosen and combined by every engine."""
+    sheets = [("Small", [["Only", "Header"], ["x", "y"]]),
+              ("Data", [["Id", "Name"]] + [[float(row), f"name {row}"] for row in range(5)]),
+              ("More", [["Id", "Name"], [10.0, "ten"], [11.0, "eleven"]])]
+
+    def read_xlsx(self, table_spec, tmpdir):
+        from tap_spreadsheets_anywhere.format_handler import get_row_iterator
+        xlsx = tmpdir / "sheets.xlsx"
+        wb = Workbook()
+        wb.remove(wb.active)
+        for name, rows in self.sheets:
+            worksheet = wb.create_sheet(name)
+            for row in rows:
+                worksheet.append(row)
+        wb.save(xlsx)
+        return [list(get_row_iterator(dict(table_spec, engine=engine), f"file://{xlsx}"))
+                for engine in ("python", "stream")]
+
+    def read_xls(self, table_spec):
+        return list(get_legacy_row_iterator(table_spec, io.BytesIO(get_legacy_workbook(self.sheets))))
+
+    def test_longest_sheet(self, tmpdir):
+        expected = [{"id": float(row), "name": f"name {row}"} for row in range(5)]
+        assert self.read_xlsx({"format": "excel"}, tmpdir) == [expected, expected]
+        assert self.read_xls({"format": "excel"}) == expected
+
+    def test_legacy_longest_sheet_from_dimensions(self):
+        from tap_spreadsheets_anywhere.excel_handler import _legacy_dimension_rows
+        workbook = xlrd.open_workbook(file_contents=get_legacy_workbook(self.sheets), on_demand=True)
+        assert [_legacy_dimension_rows(workbook, index) for index in range(3)] == [2, 6, 3]
+        assert not any(workbook.sheet_loaded(index) for index in range(3))
+
+    def test_legacy_ole2_workbook(self):
+        from tap_spreadsheets_anywhere.excel_handler import _legacy_dimension_rows
+        from tap_spreadsheets_anywhere.format_handler import get_row_iterator
+        # Written by xlwt, so the sheets sit inside a real OLE2 compound file
+        path = os.path.join(os.path.dirname(__file__), "sheets.xls")
+        workbook = xlrd.open_workbook(path, on_demand=True, use_mmap=True)
+        assert [_legacy_dimension_rows(workbook, index) for index in range(3)] == [2, 6, 3]
+        assert not any(workbook.sheet_loaded(index) for index in range(3))
+        workbook.release_resources()
+
+        expected = [{"id": float(row), "name": f"name {row}"} for row in range(5)]
+        assert list(get_row_iterator({"format": "excel"}, f"file://{path}")) == expected
+        assert list(get_row_iterator({"format": "excel", "worksheet_names": ["More"]}, path)) == \
+            [{"id": 10.0, "name": "ten", "_smart_source_worksheet": "More"},
+             {"id": 11.0, "name": "eleven", "_smart_source_worksheet": "More"}]
+
+    def test_legacy_dimensions_fall_back_to_loading_sheets(self):
+        from tap_spreadsheets_anywhere.excel_handler import _legacy_dimension_rows
+        workbook = xlrd.open_workbook(file_contents=get_legacy_workbook(self.sheets), on_demand=True)
+        # As if a later xlrd release renamed the private attribute
+        with patch("tap_spreadsheets_anywhere.excel_handler._stored_dimension_rows",
+                   side_effect=AttributeError("'Book' object has no attribute '_sh_abs_posn'")):
+            assert [_legacy_dimension_rows(workbook, index) for index in range(3)] == [2, 6, 3]
+            assert self.read_xls({"format": "excel"}) == [{"id": float(row), "name": f"name {row}"}
+                                                          for row in range(5)]
+
+    def test_worksheet_names(self, tmpdir):
+        table_spec = {"format": "excel", "worksheet_names": ["More", "Small"]}
+        expected = [{"id": 10.0, "name": "ten", "_smart_source_worksheet": "More"},
+                    {"id": 11.0, "name": "eleven", "_smart_source_worksheet": "More"},
+                    {"only": "x", "header": "y", "_smart_source_worksheet": "Small"}]
+        assert self.read_xlsx(table_spec, tmpdir) == [expected, expected]
+        assert self.read_xls(table_spec) == expected
+
+    def test_missing_worksheet(self, tmpdir):
+        with pytest.raises(KeyError):
+            self.read_xlsx({"format": "excel", "worksheet_names": ["More", "Missing"]}, tmpdir)
+        with pytest.raises(KeyError):
+            self.read_xls({"format": "excel", "worksheet_name": "Missing"})
+
+
+class TestLegacySpooling:
+    """Validate that .xls files are read from a temporary local copy that is removed afterwards."""
+    sheets = [("Data", [["Id", "Name"]] + [[float(row), f"name {row}"] for row in range(3)])]
+
+    def test_spooled_copy_is_removed(self, tmpdir):
+        with patch("tempfile.tempdir", str(tmpdir)), \
+                patch("xlrd.open_workbook", wraps=xlrd.open_workbook) as open_workbook:
+            iterator = get_legacy_row_iterator({"format": "excel"}, io.BytesIO(get_legacy_workbook(self.sheets)))
+            assert len(tmpdir.listdir()) == 1
+            assert next(iterator) == {"id": 0.0, "name": "name 0"}
+            assert list(iterator) == [{"id": 1.0, "name": "name 1"}, {"id": 2.0, "name": "name 2"}]
+            assert tmpdir.listdir() == []
+
+            iterator = get_legacy_row_iterator({"format": "excel"}, io.BytesIO(get_legacy_workbook(self.sheets)))
+            next(iterator)
+            iterator.close()
+            assert tmpdir.listdir() == []
+        assert all(call.kwargs.get("file_contents") is None for call in open_workbook.call_args_list)
+
+
+class TestSpoolToDisk:
+    """Validate that compressed .xlsx files are read from a spooled copy that is closed once read."""
+
+    def test_spooled_workbook(self, tmpdir):
+        import gzip
+        from tap_spreadsheets_anywhere import spooling
+        from tap_spreadsheets_anywhere.format_handler import get_row_iterator
+        xlsx = tmpdir / "types.xlsx"
+        TestStreamingEngine().write_workbook(xlsx)
+        compressed = tmpdir / "types.xlsx.gz"
+        compressed.write_binary(gzip.compress(xlsx.read_binary()))
+        spool_dir = tmpdir.mkdir("spool")
+        spool_stream = spooling.spool_stream
+
+        for engine in ("openpyxl", "stream"):
+            table_spec = {"format": "excel", "worksheet_name": "Data", "engine": engine}
+            expected = list(get_row_iterator(table_spec, f"file://{xlsx}"))
+            spooled = []
+            with patch("tempfile.tempdir", str(spool_dir)), \
+                    patch("tap_spreadsheets_anywhere.spooling.spool_stream",
+                          side_effect=lambda *args: spooled.append(spool_stream(*args)) or spooled[-1]):
+                rows = list(get_row_iterator(dict(table_spec, spool_to_disk=True, spool_memory_bytes=1024),
+                                             f"file://{compressed}"))
+                assert spool_dir.listdir() == []
+            assert len(rows) == 45
+            assert rows == expected
+            assert len(spooled) == 1 and spooled[0].closed
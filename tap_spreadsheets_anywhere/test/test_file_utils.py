@@ -0,0 +1,128 @@
+import os
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from tap_spreadsheets_anywhere import file_utils, format_handler
+
+
+class TestLocalListing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        root = Path(self.tmpdir.name)
+        for relpath in ('a.csv', 'sub/b.csv', 'sub/deeper/c.csv', 'z/d.csv'):
+            (root / relpath).parent.mkdir(parents=True, exist_ok=True)
+            (root / relpath).write_text("id\n1\n")
+        os.utime(root / 'a.csv', (1600000000, 1600000000))
+        os.symlink(root / 'missing.csv', root / 'broken.csv')
+        os.symlink(root / 'sub', root / 'linked_dir')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_matches_walk(self):
+        listed = list(file_utils.list_files_in_local_bucket(self.tmpdir.name))
+        walked = [os.path.relpath(os.path.join(dirpath, filename), self.tmpdir.name)
+                  for dirpath, _, filenames in os.walk(self.tmpdir.name) for filename in filenames
+                  if os.path.exists(os.path.join(dirpath, filename))]
+        self.assertEqual(sorted(obj['Key'] for obj in listed), sorted(walked))
+        self.assertEqual(sorted(obj['Key'] for obj in listed),
+                         ['a.csv', os.path.join('sub', 'b.csv'), os.path.join('sub', 'deeper', 'c.csv'),
+                          os.path.join('z', 'd.csv')])
+        a_csv = next(obj for obj in listed if obj['Key'] == 'a.csv')
+        self.assertEqual(a_csv['LastModified'], datetime.fromtimestamp(1600000000, timezone.utc))
+
+    def test_search_prefix_and_limit(self):
+        listed = list(file_utils.list_files_in_local_bucket(self.tmpdir.name, 'sub'))
+        self.assertEqual(sorted(obj['Key'] for obj in listed), ['b.csv', os.path.join('deeper', 'c.csv')])
+
+        with self.assertRaises(ValueError):
+            list(file_utils.list_files_in_local_bucket(self.tmpdir.name, max_listed_files=3))
+        self.assertEqual(len(list(file_utils.list_files_in_local_bucket(self.tmpdir.name, max_listed_files=-1))), 4)
+
+
+class TestMatchingObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        mtimes = {'e.csv': 500, 'b.csv': 100, 'd.csv': 300, 'a.csv': 300, 'c.csv': 200, 'skip.txt': 50}
+        for name, mtime in mtimes.items():
+            path = Path(self.tmpdir.name, name)
+            path.write_text("id\n1\n")
+            os.utime(path, (1600000000 + mtime, 1600000000 + mtime))
+        self.table_spec = {'path': f'file://{self.tmpdir.name}', 'pattern': '\\.csv$'}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_oldest_first(self):
+        expected = sorted(file_utils.list_matching_objects(self.table_spec)[0], key=lambda obj: obj['last_modified'])
+        self.assertEqual(file_utils.get_matching_objects(self.table_spec), expected)
+        self.assertEqual([obj['key'] for obj in expected][:2], ['b.csv', 'c.csv'])
+
+        modified_since = datetime.fromtimestamp(1600000150, timezone.utc)
+        self.assertEqual(file_utils.get_matching_objects(self.table_spec, modified_since), expected[1:])
+
+    def test_limit(self):
+        everything = file_utils.get_matching_objects(self.table_spec)
+        self.assertEqual(file_utils.get_matching_objects(self.table_spec, limit=3), everything[:3])
+
+
+class TestFormatDetection(unittest.TestCase):
+
+    def test_detected_once_per_file(self):
+        with TemporaryDirectory() as tmpdir:
+            Path(tmpdir, 'export').write_text('id,name\n1,first\n2,second\n')
+            table_spec = {'path': f'file://{tmpdir}', 'name': 'data', 'format': 'detect', 'delimiter': ','}
+            schema = {'properties': {'id': {'type': ['null', 'integer']}}}
+            for read in (lambda spec: list(file_utils.read_records(spec, f'file://{tmpdir}/export', schema)),
+                         lambda spec: file_utils.sample_file(spec, 'export', 1, 10),
+                         lambda spec: file_utils.sample_file(dict(spec, sampling='spread'), 'export', 1, 10)):
+                for engine in ('python', 'arrow'):
+                    with patch('tap_spreadsheets_anywhere.format_handler.detect_format',
+                               wraps=format_handler.detect_format) as detect_format:
+                        self.assertEqual(len(read(dict(table_spec, engine=engine))), 2)
+                    self.assertEqual(detect_format.call_count, 1)
+
+
+class TestSpreadSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        lines = ['id,value,note']
+        for row in range(20000):
+            # Values only turn into decimals at the tail of the file, and notes hold quoted newlines
+            value = f'{row}.5' if row >= 18000 else str(row)
+            lines.append(f'{row},{value},"note {row}\nsecond line, with comma"')
+        Path(self.tmpdir.name, 'data.csv').write_text('\n'.join(lines) + '\n')
+        Path(self.tmpdir.name, 'data.jsonl').write_text(
+            ''.join(f'{{"id": {row}, "value": {row + 0.5 if row >= 18000 else row}}}\n' for row in range(20000)))
+        self.table_spec = {'path': f'file://{self.tmpdir.name}', 'name': 'data', 'format': 'csv',
+                           'sampling': 'spread', 'sample_windows': 4, 'sample_window_bytes': 4096}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_spread_csv_samples_reach_the_tail(self):
+        head = file_utils.sample_file({**self.table_spec, 'sampling': 'head'}, 'data.csv', 5, 100)
+        self.assertTrue(all(not row['value'].endswith('.5') for row in head))
+
+        samples = file_utils.sample_file(self.table_spec, 'data.csv', 5, 100)
+        self.assertEqual(len(samples), 100)
+        self.assertEqual(samples[0], {'id': '0', 'value': '0', 'note': 'note 0\nsecond line, with comma'})
+        self.assertTrue(any(row['value'].endswith('.5') for row in samples))
+        for row in samples:
+            self.assertEqual(row['note'], f"note {row['id']}\nsecond line, with comma")
+
+    def test_spread_jsonl_samples_reach_the_tail(self):
+        samples = file_utils.sample_file({**self.table_spec, 'format': 'jsonl'}, 'data.jsonl', 5, 100)
+        self.assertEqual(len(samples), 100)
+        self.assertEqual(samples[0], {'id': 0, 'value': 0})
+        self.assertEqual(max(row['id'] for row in samples) // 1000, 19)
+
+    def test_small_files_sampled_from_head(self):
+        samples = file_utils.sample_file({**self.table_spec, 'sample_window_bytes': 10 ** 6}, 'data.csv', 5, 10)
+        self.assertEqual([row['id'] for row in samples], [str(row) for row in range(0, 50, 5)])
@@ -0,0 +1,109 @@
+import threading
+import unittest
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tap_spreadsheets_anywhere import file_utils, transports
+from tap_spreadsheets_anywhere.format_handler import get_row_iterator
+
+BODY = b"id,name\n1,first\n2,second\n"
+LAST_MODIFIED = 'Wed, 21 Oct 2020 07:28:00 GMT'
+ETAG = '"v1"'
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_file_headers(self):
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return False
+        self.send_response(200)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        return True
+
+    def do_HEAD(self):
+        self.requests.append('HEAD')
+        self.send_file_headers()
+
+    def do_GET(self):
+        self.requests.append('GET')
+        if self.send_file_headers():
+            self.wfile.write(BODY)
+
+
+class NoHeadSourceHandler(SourceHandler):
+    requests = []
+
+    def do_HEAD(self):
+        self.requests.append('HEAD')
+        self.send_response(405)
+        self.end_headers()
+
+
+class TestHTTPSource(unittest.TestCase):
+
+    def serve(self, handler):
+        handler.requests.clear()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return {'path': f'http://127.0.0.1:{server.server_port}/files', 'pattern': 'data.csv', 'name': 'data',
+                'format': 'csv', 'delimiter': ',', 'start_date': '2017-05-01T00:00:00Z'}
+
+    def tearDown(self):
+        transports.reset()
+
+    def read_rows(self, table_spec):
+        return list(get_row_iterator(table_spec, file_utils.resolve_target_uri(table_spec, 'data.csv')))
+
+    def test_head_then_single_download(self):
+        table_spec = self.serve(SourceHandler)
+        start_date = datetime(2017, 5, 1, tzinfo=timezone.utc)
+        target_files = file_utils.get_matching_objects(table_spec, start_date)
+        self.assertEqual(target_files, [{'key': 'data.csv', 'etag': ETAG,
+                                         'last_modified': datetime(2020, 10, 21, 7, 28, tzinfo=timezone.utc)}])
+        self.assertEqual(len(self.read_rows(table_spec)), 2)
+        self.assertEqual(SourceHandler.requests, ['HEAD', 'GET'])
+
+        # A later run with the bookmark of the synced file only sends one conditional HEAD request
+        transports.reset()
+        SourceHandler.requests.clear()
+        unchanged = file_utils.get_matching_objects(table_spec, target_files[0]['last_modified'], etag=ETAG)
+        self.assertEqual(unchanged, [])
+        self.assertEqual(SourceHandler.requests, ['HEAD'])
+
+    def test_get_fallback_reuses_body(self):
+        table_spec = self.serve(NoHeadSourceHandler)
+        target_files = file_utils.get_matching_objects(table_spec, datetime(2017, 5, 1, tzinfo=timezone.utc))
+        self.assertEqual(len(target_files), 1)
+        self.assertEqual(self.read_rows(table_spec)[1], {'id': '2', 'name': 'second'})
+        self.assertEqual(NoHeadSourceHandler.requests, ['HEAD', 'GET'])
+
+    def test_fallback_body_is_released_once_read(self):
+        table_spec = self.serve(NoHeadSourceHandler)
+        file_utils.get_matching_objects(table_spec, datetime(2017, 5, 1, tzinfo=timezone.utc))
+        self.assertEqual(len(transports._HTTP_BODIES), 1)
+        self.assertEqual(len(self.read_rows(table_spec)), 2)
+        self.assertEqual(transports._HTTP_BODIES, {})
+        # Later opens stream the file again rather than keeping its body in memory
+        self.assertEqual(len(self.read_rows(table_spec)), 2)
+        self.assertEqual(transports._HTTP_BODIES, {})
+        self.assertEqual(NoHeadSourceHandler.requests, ['HEAD', 'GET', 'GET'])
+
+    def test_format_detection_keeps_fallback_body(self):
+        table_spec = dict(self.serve(NoHeadSourceHandler), pattern='export', format='detect')
+        target_files = file_utils.get_matching_objects(table_spec, datetime(2017, 5, 1, tzinfo=timezone.utc))
+        uri = file_utils.resolve_target_uri(table_spec, target_files[0]['key'])
+        self.assertEqual(list(get_row_iterator(table_spec, uri))[0], {'id': '1', 'name': 'first'})
+        self.assertEqual(transports._HTTP_BODIES, {})
+        self.assertEqual(NoHeadSourceHandler.requests, ['HEAD', 'GET'])
@@ -1,4 +1,6 @@
+import json
 import unittest
+from json import JSONDecodeError
 
 import dateutil
 from io import StringIO
@@ -57,3 +59,52 @@ class TestFormatHandler(unittest.TestCase):
         iterator = json_handler.get_row_iterator(TEST_TABLE_SPEC['tables'][2], reader)
         for row in iterator:
             self.assertEqual(row['k'], 'v')
+
+    def test_json_path_expression_reads_the_document_once(self):
+        class UnseekableReader(StringIO):
+            def seek(self, *args):
+                raise OSError('not seekable')
+
+        document = '{"before": [1, 2], "response": {"data": [{"k":"v"},{"k":"w"}]}, "a.b": [{"k":"x"}]}'
+        for json_path, expected in (("response.data[*]", ['v', 'w']), ("a.b", ['x']), ("missing", [])):
+            iterator = json_handler.get_row_iterator({"json_path": json_path}, UnseekableReader(document))
+            self.assertEqual([row['k'] for row in iterator], expected)
+
+    def test_json_stream_chunk_boundaries(self):
+        objects = [{"Id": i, "Value": 10 ** i, "Text": "x, ] } " * i, "Nested": {"list": [i, [i]]}} for i in range(20)]
+        document = json.dumps({"skipped": {"a": [1, 2, {"b": "]"}]}, "someKey": objects, "after": 1}, indent=2)
+        for chunk_size in (1, 7, 64):
+            stream = json_handler.JSONStream(StringIO(document), chunk_size=chunk_size)
+            self.assertTrue(stream.find_key("someKey"))
+            self.assertEqual(list(stream.iter_array()), objects)
+
+    def test_json_array_is_streamed(self):
+        reader = StringIO('[{"k":"v"},{"k":"w"}, not json')
+        iterator = json_handler.get_row_iterator(TEST_TABLE_SPEC['tables'][0], reader)
+        self.assertEqual(next(iterator), {'k': 'v'})
+        self.assertEqual(next(iterator), {'k': 'w'})
+        with self.assertRaises(JSONDecodeError):
+            next(iterator)
+
+    def test_json_malformed_element_fails_without_reading_on(self):
+        for malformed in ('{"k": }', '{"k": "v" "w"}', '{"k": "line\nbreak"}', '{"k": tru}', '{"k": "v"} x'):
+            reader = StringIO('[{"k": "v"}, ' + malformed + ', ' + ', '.join(['{"k": "v"}'] * 10000) + ']')
+            stream = json_handler.JSONStream(reader, chunk_size=64)
+            with self.assertRaises(JSONDecodeError):
+                list(json_handler.iter_array_document(stream))
+            self.assertLess(reader.tell(), 1024)
+        for chunk_size in (1, 5, 64):
+            stream = json_handler.JSONStream(StringIO('[-Infinity, "\\u00e9' + 'x' * 200 + '", true, 1.5e10]'),
+                                             chunk_size=chunk_size)
+            self.assertEqual(list(stream.iter_array()), [float('-inf'), '\u00e9' + 'x' * 200, True, 1.5e10])
+
+    def test_json_concatenated_objects(self):
+        reader = StringIO('{"k":"v"}\n{"k":\n "w"}\n\n{"k":"x"}\n')
+        rows = list(json_handler.get_row_iterator(TEST_TABLE_SPEC['tables'][0], reader))
+        self.assertEqual(rows, [{'k': 'v'}, {'k': 'w'}, {'k': 'x'}])
+
+    def test_json_invalid_document(self):
+        with self.assertRaises(JSONDecodeError):
+            json_handler.get_row_iterator(TEST_TABLE_SPEC['tables'][0], StringIO('[{"k": }]'))
+        with self.assertRaises(JSONDecodeError):
+            list(json_handler.get_row_iterator(TEST_TABLE_SPEC['tables'][0], StringIO('[{"k":"v"}] [')))
@@ -1,7 +1,9 @@
 import logging
 import unittest
+from io import StringIO
+from unittest.mock import patch
 
-from tap_spreadsheets_anywhere import format_handler
+from tap_spreadsheets_anywhere import format_handler, jsonl_handler
 
 LOGGER = logging.getLogger(__name__)
 
@@ -121,3 +123,12 @@ class TestJsonFormatHandler(unittest.TestCase):
             row_count += 1
             self.assertEqual(3884, row['id'], f"ID field is {row['id']} - expected it to be 3884.")
         self.assertEqual(expected_row_count, row_count, f"Expected row_count to be {expected_row_count} but was {row_count}")
+
+    def test_jsonl_blank_lines_and_batches(self):
+        lines = ''.join(f'{{"Id": {i}, "Big": {2 ** 70}, "Nan": NaN}}\n' + ('\n' if i % 3 == 0 else '') for i in range(10))
+        expected = list(range(10))
+        for decoder in (jsonl_handler.orjson, None):
+            with patch('tap_spreadsheets_anywhere.jsonl_handler.orjson', decoder):
+                rows = list(jsonl_handler.generator_wrapper(iter(StringIO(lines + '  \n')), batch_size=4))
+            self.assertEqual([row['id'] for row in rows], expected)
+            self.assertEqual(rows[0]['big'], 2 ** 70)
@@ -0,0 +1,137 @@
+import os
+import threading
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from tap_spreadsheets_anywhere import file_utils, listing_cache, transports
+
+
+class FakeS3Client():
+    """Answers list_objects_v2 like S3 does, including delimiters and pagination."""
+
+    def __init__(self, keys, page_size=1000):
+        self.keys = keys
+        self.page_size = page_size
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, StartAfter='', ContinuationToken=None, MaxKeys=1000):
+        with self.lock:
+            self.calls.append({k: v for k, v in locals().items() if k not in ('self', 'k', 'v') and v})
+        entries = []
+        for key in sorted(self.keys):
+            if not key.startswith(Prefix) or key <= StartAfter:
+                continue
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = key[:key.index(Delimiter, len(Prefix)) + 1]
+                if not entries or entries[-1] != ('prefix', common_prefix):
+                    entries.append(('prefix', common_prefix))
+            else:
+                entries.append(('key', key))
+        offset = int(ContinuationToken or 0)
+        page = entries[offset:offset + min(MaxKeys, self.page_size)]
+        result = {
+            'KeyCount': len(page),
+            'Contents': [{'Key': key, 'LastModified': datetime(2021, 1, 1, tzinfo=timezone.utc), 'ETag': '"x"',
+                          'Size': 1, 'StorageClass': 'STANDARD'} for kind, key in page if kind == 'key'],
+            'CommonPrefixes': [{'Prefix': prefix} for kind, prefix in page if kind == 'prefix'],
+        }
+        if offset + len(page) < len(entries):
+            result['NextContinuationToken'] = str(offset + len(page))
+        return result
+
+
+class TestListingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, 'cache')
+        self.data_dir = os.path.join(self.tmpdir.name, 'data')
+        os.makedirs(self.data_dir)
+        for name in ('a.csv', 'b.csv', 'c.txt'):
+            Path(self.data_dir, name).write_text("id\n1\n")
+        self.table_spec = {'path': f'file://{self.data_dir}', 'pattern': '.*\\.csv', 'name': 'things'}
+
+    def tearDown(self):
+        listing_cache.reset()
+        transports.reset()
+        self.tmpdir.cleanup()
+
+    def test_listing_reused_within_run(self):
+        listing_cache.configure({})
+        with patch.object(file_utils, 'list_files_in_local_bucket', wraps=file_utils.list_files_in_local_bucket) as lister:
+            first = file_utils.get_matching_objects(self.table_spec)
+            second = file_utils.get_matching_objects(self.table_spec, datetime(1970, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(lister.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(sorted(obj['key'] for obj in first), ['a.csv', 'b.csv'])
+
+    def test_manifest_reused_across_runs(self):
+        listing_cache.configure({'listing_cache_dir': self.cache_dir, 'listing_cache_max_age': 3600})
+        first = file_utils.get_matching_objects(self.table_spec)
+
+        listing_cache.configure({'listing_cache_dir': self.cache_dir, 'listing_cache_max_age': 3600})
+        with patch.object(file_utils, 'list_files_in_local_bucket') as lister:
+            second = file_utils.get_matching_objects(self.table_spec)
+        lister.assert_not_called()
+        self.assertEqual(first, second)
+
+        # An expired manifest is listed again
+        listing_cache.configure({'listing_cache_dir': self.cache_dir})
+        Path(self.data_dir, 'd.csv').write_text("id\n1\n")
+        third = file_utils.get_matching_objects(self.table_spec)
+        self.assertEqual(sorted(obj['key'] for obj in third), ['a.csv', 'b.csv', 'd.csv'])
+
+    def test_incremental_s3_listing(self):
+        table_spec = {'path': 's3://bucket', 'search_prefix': 'exports/', 'pattern': '\\.csv$', 'name': 'things',
+                      'incremental_listing': True}
+        client = FakeS3Client(['exports/2021-01-01.csv', 'exports/2021-01-02.csv', 'exports/2021-01-02.log'])
+        with patch('boto3.client', return_value=client):
+            listing_cache.configure({'listing_cache_dir': self.cache_dir})
+            first = file_utils.get_matching_objects(table_spec)
+
+            client.keys.append('exports/2021-01-03.csv')
+            listing_cache.configure({'listing_cache_dir': self.cache_dir})
+            second = file_utils.get_matching_objects(table_spec)
+
+        self.assertEqual(len(first), 2)
+        self.assertEqual([obj['key'] for obj in second],
+                         ['exports/2021-01-01.csv', 'exports/2021-01-02.csv', 'exports/2021-01-03.csv'])
+        self.assertNotIn('StartAfter', client.calls[0])
+        self.assertEqual(client.calls[1]['StartAfter'], 'exports/2021-01-02.log')
+
+
+class TestShardedS3Listing(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['exports/readme.txt'] + [f'exports/{year}/{month:02d}/part-{part}.csv'
+                                              for year in (2020, 2021) for month in range(1, 13) for part in range(3)]
+        self.client = FakeS3Client(self.keys, page_size=7)
+
+    def tearDown(self):
+        transports.reset()
+
+    def list(self, **kwargs):
+        with patch('boto3.client', return_value=self.client):
+            return list(file_utils.list_files_in_s3_bucket('bucket', 'exports/', **kwargs))
+
+    def test_sharded_listing_matches_serial(self):
+        serial = self.list()
+        sharded = self.list(max_parallel_listing=8)
+        self.assertEqual(serial, sharded)
+        self.assertEqual([obj['Key'] for obj in sharded], sorted(self.keys))
+        self.assertEqual(set(sharded[0]), {'Key', 'LastModified'})
+        # Shards are the month prefixes, found two levels down
+        shard_calls = [call for call in self.client.calls if 'Delimiter' not in call and call['Prefix'] != 'exports/']
+        self.assertEqual(len({call['Prefix'] for call in shard_calls}), 24)
+
+    def test_sharded_listing_after_start(self):
+        start_after = 'exports/2021/06/part-1.csv'
+        serial = self.list(start_after=start_after)
+        sharded = self.list(start_after=start_after, max_parallel_listing=4)
+        self.assertEqual(serial, sharded)
+        self.assertEqual(sharded[0]['Key'], 'exports/2021/06/part-2.csv')
+        self.assertEqual(len(sharded), 1 + 6 * 3 + 1)
@@ -0,0 +1,32 @@
+import unittest
+from io import StringIO
+
+from tap_spreadsheets_anywhere import csv_handler
+from tap_spreadsheets_anywhere.normalization import normalize_key, normalize_header, normalize_keys
+
+
+class TestNormalization(unittest.TestCase):
+
+    def test_normalize_key(self):
+        self.assertEqual(normalize_key('Leaf Color'), 'leaf_color')
+        self.assertEqual(normalize_key('  Net (GBP)  '), '_net_gbp_')
+        self.assertEqual(normalize_key('Invoice\tNumber #'), 'invoice_number_')
+        self.assertEqual(normalize_key(None), '_smart_extra')
+
+    def test_normalize_header_and_keys(self):
+        self.assertEqual(normalize_header(['Type', 'Leaf Color']), ['type', 'leaf_color'])
+        self.assertEqual(normalize_keys({'Type': 1, 'Leaf-Color': 2}), {'type': 1, 'leafcolor': 2})
+
+    def test_csv_ragged_rows(self):
+        reader = StringIO('Id,First Name,Cost\n1,Connor,2\n\n2,Sam\n3,Alex,4,extra,more\n')
+        rows = list(csv_handler.get_row_iterator({'delimiter': ','}, reader))
+        self.assertEqual(rows, [
+            {'id': '1', 'first_name': 'Connor', 'cost': '2'},
+            {'id': '2', 'first_name': 'Sam', 'cost': None},
+            {'id': '3', 'first_name': 'Alex', 'cost': '4', '_smart_extra': ['extra', 'more']},
+        ])
+
+    def test_csv_field_names(self):
+        reader = StringIO('1,Connor\n2,Sam\n')
+        rows = list(csv_handler.get_row_iterator({'delimiter': ',', 'field_names': ['Id', 'First Name']}, reader))
+        self.assertEqual(rows, [{'id': '1', 'first_name': 'Connor'}, {'id': '2', 'first_name': 'Sam'}])
@@ -0,0 +1,44 @@
+import json
+import unittest
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+import singer
+
+from tap_spreadsheets_anywhere import output
+
+
+class TestBufferedMessageWriter(unittest.TestCase):
+
+    def test_buffers_until_state(self):
+        writer = output.BufferedMessageWriter(buffer_bytes=10 ** 6, flush_seconds=60)
+        state = {}
+        with patch('tap_spreadsheets_anywhere.output._WRITER', writer), \
+                patch('sys.stdout', new_callable=StringIO) as fake_out:
+            output.write_schema('things', {'properties': {'id': {'type': 'integer'}}}, 'id')
+            for index in range(3):
+                output.write_record('things', {'id': index, 'name': 'café'})
+            self.assertEqual(fake_out.getvalue(), '')
+            output.write_bookmark(state, 'things', {'modified_since': '2020-01-01T00:00:00+00:00'})
+            messages = [json.loads(line) for line in fake_out.getvalue().splitlines()]
+
+        self.assertEqual([m['type'] for m in messages], ['SCHEMA', 'RECORD', 'RECORD', 'RECORD', 'STATE'])
+        self.assertEqual(messages[0]['key_properties'], ['id'])
+        self.assertEqual(messages[2]['record'], {'id': 1, 'name': 'café'})
+        self.assertEqual(messages[4]['value'], {'things': {'modified_since': '2020-01-01T00:00:00+00:00'}})
+
+    def test_flushes_on_size(self):
+        writer = output.BufferedMessageWriter(buffer_bytes=100, flush_seconds=60)
+        with patch('sys.stdout', new_callable=StringIO) as fake_out:
+            writer.write(singer.RecordMessage(stream='things', record={'id': 1}))
+            self.assertEqual(fake_out.getvalue(), '')
+            writer.write(singer.RecordMessage(stream='things', record={'id': 2, 'text': 'x' * 100}))
+            self.assertEqual(len(fake_out.getvalue().splitlines()), 2)
+
+    def test_format_message_matches_singer(self):
+        message = singer.RecordMessage(stream='things', record={'id': 1, 'amount': Decimal('1.10'), 'name': 'café'})
+        for backend in (output.orjson, None):
+            with patch('tap_spreadsheets_anywhere.output.orjson', backend):
+                self.assertEqual(json.loads(output.format_message(message)),
+                                 json.loads(singer.format_message(message)))
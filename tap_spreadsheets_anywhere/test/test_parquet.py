@@ -1,7 +1,15 @@
 import logging
 import unittest
+from datetime import date, datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
-from tap_spreadsheets_anywhere import format_handler
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tap_spreadsheets_anywhere import format_handler, file_utils, spooling
+from tap_spreadsheets_anywhere.conversion import convert_row
 
 LOGGER = logging.getLogger(__name__)
 
@@ -129,3 +137,123 @@ class TestParquet(unittest.TestCase):
                 "carb": 4,
             },
         )
+
+    def test_typed_records(self):
+        table = pa.table({
+            "Id": pa.array([1, 2, None], pa.int32()),
+            "Cost": pa.array([1.5, None, 2.0]),
+            "Count As Text": pa.array([7, 8, 9]),
+            "Name": pa.array(["a", " ", None]).dictionary_encode(),
+            "Flag": pa.array([True, False, None]),
+            "Created": pa.array([datetime(2020, 1, 1, 1, 2, 3), datetime(1969, 12, 31, 23, 59, 59, 500),
+                                 None], pa.timestamp("ns")),
+            "Updated": pa.array([datetime(2020, 1, 1, tzinfo=timezone.utc)] * 3, pa.timestamp("ms", "Europe/Paris")),
+            "Day": pa.array([date(2020, 1, 2)] * 3),
+        })
+        schema = {"properties": {
+            "id": {"type": ["null", "integer"]},
+            "cost": {"type": ["null", "number"]},
+            "count_as_text": {"type": ["null", "string"]},
+            "name": {"type": ["null", "string"]},
+            "flag": {"type": ["null", "string"]},
+            "created": {"type": ["null", "date-time"]},
+            "updated": {"type": ["null", "date-time"]},
+            "day": {"type": ["null", "date-time"]},
+        }}
+        with TemporaryDirectory() as tmpdir:
+            uri = str(Path(tmpdir) / "typed.parquet")
+            pq.write_table(table, uri)
+            table_spec = {"format": "parquet"}
+            records = list(file_utils.read_records(table_spec, uri, schema))
+            rows = list(format_handler.get_row_iterator(table_spec, uri))
+
+        for record, row in zip(records, rows):
+            expected = convert_row(row, schema)
+            for key in ("id", "cost", "count_as_text", "name", "flag"):
+                self.assertEqual(record[key], expected[key])
+        self.assertEqual(records[0]["count_as_text"], "7")
+        self.assertEqual(records[1]["name"], None)
+        self.assertEqual([r["created"] for r in records],
+                         ["2020-01-01T01:02:03+00:00", "1969-12-31T23:59:59.000500+00:00", None])
+        self.assertEqual(records[0]["updated"], "2020-01-01T00:00:00+00:00")
+        self.assertEqual(records[0]["day"], "2020-01-02T00:00:00+00:00")
+
+    def test_parallel_row_groups(self):
+        table = pa.table({"Row Id": list(range(1000)), "Label": [f"row {i}" for i in range(1000)]})
+        schema = {"properties": {"row_id": {"type": ["null", "integer"]}, "label": {"type": ["null", "string"]}}}
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "row-groups.parquet"
+            pq.write_table(table, path, row_group_size=64)
+            serial_spec = {"format": "parquet", "skip_initial": 3}
+            parallel_spec = {**serial_spec, "max_parallel_row_groups": 4}
+            serial = list(file_utils.read_records(serial_spec, str(path), schema))
+            parallel_local = list(file_utils.read_records(parallel_spec, f"file://{path}", schema))
+            with patch("tap_spreadsheets_anywhere.format_handler.get_local_path", return_value=None):
+                parallel_stream = list(file_utils.read_records(parallel_spec, f"file://{path}", schema))
+
+        self.assertEqual(len(serial), 997)
+        self.assertEqual(serial, parallel_local)
+        self.assertEqual(serial, parallel_stream)
+        self.assertEqual(parallel_local[0], {"row_id": 3, "label": "row 3"})
+
+    def test_non_finite_floats_are_rejected(self):
+        schema = {"properties": {"ratio": {"type": ["null", "number"]}}}
+        with TemporaryDirectory() as tmpdir:
+            uri = str(Path(tmpdir) / "ratios.parquet")
+            pq.write_table(pa.table({"ratio": [0.5, None, 1.5]}), uri)
+            self.assertEqual(list(file_utils.read_records({"format": "parquet"}, uri, schema)),
+                             [{"ratio": 0.5}, {"ratio": None}, {"ratio": 1.5}])
+            pq.write_table(pa.table({"ratio": [0.5, None, float("nan")]}), uri)
+            with self.assertRaises(ValueError):
+                list(file_utils.read_records({"format": "parquet"}, uri, schema))
+
+    def test_parallel_row_groups_close_their_files(self):
+        from tap_spreadsheets_anywhere import parquet_handler
+        table = pa.table({"id": list(range(1000))})
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "row-groups.parquet"
+            pq.write_table(table, path, row_group_size=64)
+            handles = []
+
+            def open_parquet_file():
+                handles.append(open(path, "rb"))
+                return pq.ParquetFile(handles[-1])
+
+            spec = {"max_parallel_row_groups": 4}
+            self.assertEqual(sum(batch.num_rows for batch in
+                                 parquet_handler.get_parallel_batch_iterator(spec, open_parquet_file)), 1000)
+            self.assertGreater(len(handles), 1)
+            self.assertTrue(all(handle.closed for handle in handles))
+
+            handles.clear()
+            batches = parquet_handler.get_parallel_batch_iterator(spec, open_parquet_file)
+            next(batches)
+            batches.close()
+            self.assertTrue(all(handle.closed for handle in handles))
+
+    def test_spool_to_disk(self):
+        import gzip
+        table = pa.table({"Row Id": list(range(500)), "Label": [f"row {i}" for i in range(500)]})
+        schema = {"properties": {"row_id": {"type": ["null", "integer"]}, "label": {"type": ["null", "string"]}}}
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as spool_dir:
+            path = Path(tmpdir) / "spooled.parquet"
+            pq.write_table(table, path, row_group_size=64)
+            # Compressed files can't be read at random offsets, so they are spooled like remote files
+            compressed = Path(tmpdir) / "spooled.parquet.gz"
+            compressed.write_bytes(gzip.compress(path.read_bytes()))
+            expected = list(file_utils.read_records({"format": "parquet"}, str(path), schema))
+
+            spool_spec = {"format": "parquet", "spool_to_disk": True, "spool_memory_bytes": 1024}
+            with patch("tempfile.tempdir", spool_dir), \
+                    patch("tap_spreadsheets_anywhere.spooling.spool_stream",
+                          wraps=spooling.spool_stream) as spool_stream:
+                spooled = list(file_utils.read_records(spool_spec, f"file://{compressed}", schema))
+                parallel = list(file_utils.read_records({**spool_spec, "max_parallel_row_groups": 3},
+                                                        f"file://{compressed}", schema))
+                local = list(file_utils.read_records(spool_spec, f"file://{path}", schema))
+                self.assertEqual(list(Path(spool_dir).iterdir()), [])
+
+        self.assertEqual(spool_stream.call_count, 1)
+        self.assertEqual(spooled, expected)
+        self.assertEqual(parallel, expected)
+        self.assertEqual(local, expected)
@@ -0,0 +1,149 @@
+import json
+import os
+import unittest
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from tap_spreadsheets_anywhere import discover, sync
+
+
+def write_csv_files(directory, file_count=5, rows_per_file=7):
+    for index in range(file_count):
+        path = Path(directory) / f"part-{index}.csv"
+        lines = ["id,name,amount"] + [f"{index * 100 + row},name {row},{row * 1.5}" for row in range(rows_per_file)]
+        path.write_text("\n".join(lines) + "\n")
+        # Make last modified order differ from name order
+        mtime = 1600000000 + (file_count - index) * 60
+        os.utime(path, (mtime, mtime))
+
+
+def run_sync(config, state=None):
+    catalog = discover(config)
+    with patch('sys.stdout', new_callable=StringIO) as fake_out:
+        sync(config, state if state is not None else {}, catalog)
+    return [json.loads(line) for line in fake_out.getvalue().splitlines() if line]
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        write_csv_files(self.tmpdir.name)
+        self.table_spec = {
+            "path": f"file://{self.tmpdir.name}",
+            "name": "parts",
+            "pattern": "part-.*\\.csv",
+            "start_date": "2017-05-01T00:00:00Z",
+            "key_properties": [],
+            "format": "csv",
+        }
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_parallel_files_match_serial_output(self):
+        serial = run_sync({"tables": [self.table_spec]})
+        parallel = run_sync({"tables": [{**self.table_spec, "max_parallel_files": 3}]})
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len([m for m in serial if m['type'] == 'RECORD']), 35)
+        self.assertEqual(serial[1]['record']['_smart_source_file'], 'part-4.csv')
+        self.assertEqual(serial[-1], {'type': 'STATE', 'value': {'parts': {'modified_since': '2020-09-13T12:31:40+00:00'}}})
+
+    def test_parallel_files_respect_max_records_per_run(self):
+        spec = {**self.table_spec, "max_records_per_run": 10}
+        serial = run_sync({"tables": [spec]})
+        parallel = run_sync({"tables": [{**spec, "max_parallel_files": 4}]})
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len([m for m in parallel if m['type'] == 'RECORD']), 10)
+        self.assertEqual([m for m in parallel if m['type'] == 'STATE'],
+                         [{'type': 'STATE', 'value': {'parts': {'modified_since': '2020-09-13T12:27:40+00:00'}}}])
+
+    def test_parallel_streams_share_state(self):
+        tables = [{**self.table_spec, "name": f"parts_{index}", "pattern": f"part-[{index}-4]\\.csv"}
+                  for index in range(4)]
+        serial = run_sync({"tables": tables})
+        parallel = run_sync({"max_parallel_streams": 3, "tables": tables})
+
+        def messages_by_stream(messages):
+            by_stream = {}
+            for message in messages:
+                if message['type'] != 'STATE':
+                    by_stream.setdefault(message['stream'], []).append(message)
+            return by_stream
+
+        self.assertEqual(messages_by_stream(serial), messages_by_stream(parallel))
+        final_state = [m for m in parallel if m['type'] == 'STATE'][-1]['value']
+        self.assertEqual(final_state, [m for m in serial if m['type'] == 'STATE'][-1]['value'])
+        self.assertEqual(sorted(final_state), ['parts_0', 'parts_1', 'parts_2', 'parts_3'])
+
+
+class TestDiscover(unittest.TestCase):
+
+    def test_parallel_discovery_matches_serial(self):
+        with TemporaryDirectory() as tmpdir:
+            write_csv_files(tmpdir)
+            for index in range(3):
+                path = Path(tmpdir) / f"other-{index}.psv"
+                path.write_text("code|when|ratio\n" + "".join(f"c{row}|2021-01-0{row + 1}|{row}.{index}\n"
+                                                                for row in range(5 + index)))
+            tables = [{"path": f"file://{tmpdir}", "name": f"parts_{index}", "pattern": f"part-[{index}-4]\\.csv",
+                       "start_date": "2017-05-01T00:00:00Z", "key_properties": [], "format": "csv",
+                       "max_sampled_files": 3, "sample_rate": 2}
+                      for index in range(3)]
+            tables.append({"path": f"file://{tmpdir}", "name": "others", "pattern": "other-.*\\.psv",
+                           "start_date": "2017-05-01T00:00:00Z", "key_properties": [], "format": "csv",
+                           "delimiter": "|", "sample_rate": 1})
+            serial = discover({"tables": tables})
+            parallel = discover({"max_parallel_discovery": 4, "tables": tables})
+
+        self.assertEqual(json.dumps(serial.to_dict()), json.dumps(parallel.to_dict()))
+        self.assertEqual([stream.tap_stream_id for stream in parallel.streams],
+                         ['parts_0', 'parts_1', 'parts_2', 'others'])
+        self.assertEqual(parallel.streams[3].schema.properties['ratio'].type, ['null', 'number'])
+
+    def test_zero_max_sampled_files_samples_oldest_file(self):
+        with TemporaryDirectory() as tmpdir:
+            write_csv_files(tmpdir)
+            catalog = discover({"tables": [{"path": f"file://{tmpdir}", "name": "parts", "pattern": "part-.*\\.csv",
+                                            "start_date": "2017-05-01T00:00:00Z", "key_properties": [],
+                                            "format": "csv", "max_sampled_files": 0}]})
+        self.assertEqual(sorted(catalog.streams[0].schema.properties),
+                         ['_smart_source_bucket', '_smart_source_file', '_smart_source_lineno', 'amount', 'id', 'name'])
+
+    def test_schema_cache_only_samples_changed_files(self):
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as cache_dir:
+            write_csv_files(tmpdir)
+            config = {"schema_cache_dir": cache_dir,
+                      "tables": [{"path": f"file://{tmpdir}", "name": "parts", "pattern": "part-.*\\.csv",
+                                  "start_date": "2017-05-01T00:00:00Z", "key_properties": [], "format": "csv"}]}
+            uncached = discover({"tables": config["tables"]})
+            first = discover(config)
+            with patch('tap_spreadsheets_anywhere.file_utils.sample_file') as sample_file:
+                second = discover(config)
+            sample_file.assert_not_called()
+
+            changed = Path(tmpdir) / "part-2.csv"
+            changed.write_text("id,name,amount\n1,one,n/a\n")
+            os.utime(changed, (1600000000 + 3 * 60, 1600000000 + 3 * 60 + 1))
+            with patch('tap_spreadsheets_anywhere.file_utils.sample_file', return_value=[]) as sample_file:
+                discover(config)
+            self.assertEqual([call.args[1] for call in sample_file.call_args_list], ['part-2.csv'])
+
+        self.assertEqual(json.dumps(uncached.to_dict()), json.dumps(first.to_dict()))
+        self.assertEqual(json.dumps(first.to_dict()), json.dumps(second.to_dict()))
+
+    def test_schema_cache_ignores_histograms_of_other_versions(self):
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as cache_dir:
+            write_csv_files(tmpdir, file_count=2)
+            table = {"path": f"file://{tmpdir}", "name": "parts", "pattern": "part-.*\\.csv",
+                     "start_date": "2017-05-01T00:00:00Z", "key_properties": [], "format": "csv"}
+            discover({"schema_cache_dir": cache_dir, "tables": [table]})
+            with patch('tap_spreadsheets_anywhere.file_utils.sample_file', return_value=[]) as sample_file:
+                discover({"schema_cache_dir": cache_dir, "tables": [{**table, "spool_to_disk": True}]})
+            sample_file.assert_not_called()
+            with patch('tap_spreadsheets_anywhere.schema_cache.HISTOGRAM_VERSION', 0), \
+                    patch('tap_spreadsheets_anywhere.file_utils.sample_file', return_value=[]) as sample_file:
+                discover({"schema_cache_dir": cache_dir, "tables": [table]})
+            self.assertEqual(sample_file.call_count, 2)
@@ -0,0 +1,257 @@
+'''Keeps one client, session or connection pool per (scheme, host, credentials) for the whole run'''
+import ftplib
+import io
+import logging
+import os
+import threading
+import types
+
+import boto3
+import requests
+from google.cloud import storage
+from azure.storage.blob import BlobServiceClient
+import smart_open.http as http_transport
+import smart_open.s3 as s3_transport
+import smart_open.ssh as ssh_transport
+import smart_open.ftp as ftp_transport
+
+LOGGER = logging.getLogger(__name__)
+
+SSH_CONNECT_KWARGS = {'allow_agent': False, 'look_for_keys': False}
+
+_CLIENTS = {}
+_IDLE_FTP_CONNECTIONS = {}
+_IDLE_SFTP_CLIENTS = {}
+_HTTP_BODIES = {}
+_LOCK = threading.Lock()
+_KEY_LOCKS = {}
+
+
+def _get_client(key, factory):
+    with _LOCK:
+        if key in _CLIENTS:
+            return _CLIENTS[key]
+        key_lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+    # Clients for different keys are created concurrently, each one only once
+    with key_lock:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = factory()
+        return _CLIENTS[key]
+
+
+def _discard_client(key):
+    with _LOCK:
+        client = _CLIENTS.pop(key, None)
+    if client is not None and hasattr(client, 'close'):
+        client.close()
+
+
+def reset():
+    """Closes every client and connection of the run."""
+    with _LOCK:
+        clients = list(_CLIENTS.values())
+        connections = [conn for pool in (_IDLE_FTP_CONNECTIONS, _IDLE_SFTP_CLIENTS)
+                       for idle in pool.values() for conn in idle]
+        _CLIENTS.clear()
+        _IDLE_FTP_CONNECTIONS.clear()
+        _IDLE_SFTP_CLIENTS.clear()
+        _HTTP_BODIES.clear()
+        _KEY_LOCKS.clear()
+    for client in clients + connections:
+        try:
+            if hasattr(client, 'close'):
+                client.close()
+        except Exception as err:
+            LOGGER.debug(f'Ignoring error while closing {client}: {err}')
+
+
+def get_s3_client():
+    return _get_client(('s3',), lambda: boto3.client('s3'))
+
+
+def get_gcs_client():
+    return _get_client(('gs',), storage.Client)
+
+
+def get_azure_client():
+    connection_string = os.environ['AZURE_STORAGE_CONNECTION_STRING']
+    return _get_client(('azure', connection_string),
+                       lambda: BlobServiceClient.from_connection_string(connection_string))
+
+
+def get_http_session():
+    return _get_client(('http',), requests.Session)
+
+
+def store_http_body(url, body):
+    """Keeps a body downloaded while listing until the file is opened, so that it is not requested twice."""
+    with _LOCK:
+        _HTTP_BODIES[url] = body
+
+
+def open_http_file(url, keep_body=False):
+    """
+    Returns the body of a URL as a binary stream. A body already fetched while listing is handed over once
+    and released, unless `keep_body` asks to keep it for a later open, and any other is streamed from the
+    server with the shared session.
+    """
+    with _LOCK:
+        body = _HTTP_BODIES.get(url) if keep_body else _HTTP_BODIES.pop(url, None)
+    if body is None:
+        return http_transport.open(url, 'rb', session=get_http_session())
+    fobj = io.BytesIO(body)
+    fobj.name = url
+    return fobj
+
+
+def _ssh_key(parsed_uri):
+    return 'sftp', parsed_uri['host'], parsed_uri['user'], parsed_uri['port'], parsed_uri['password']
+
+
+def get_ssh_client(uri):
+    parsed_uri = ssh_transport.parse_uri(uri)
+    key = _ssh_key(parsed_uri)
+    ssh = _get_client(key, lambda: ssh_transport._connect_ssh(parsed_uri['host'], parsed_uri['user'],
+                                                               parsed_uri['port'], parsed_uri['password'],
+                                                               SSH_CONNECT_KWARGS))
+    transport = ssh.get_transport()
+    if transport is None or not transport.active:
+        LOGGER.info(f"Reconnecting to {parsed_uri['host']}.")
+        _discard_client(key)
+        return get_ssh_client(uri)
+    return ssh
+
+
+def acquire_sftp_client(uri):
+    """
+    Takes an idle SFTP channel of the run's SSH session to the uri's host from the run's pool, or opens a new
+    one, so that no more channels are open than files are read or listed at once.
+    """
+    key = _ssh_key(ssh_transport.parse_uri(uri))
+    while True:
+        with _LOCK:
+            idle = _IDLE_SFTP_CLIENTS.get(key)
+            sftp_client = idle.pop() if idle else None
+        if sftp_client is None:
+            return get_ssh_client(uri).get_transport().open_sftp_client()
+        if not sftp_client.get_channel().closed:
+            return sftp_client
+        sftp_client.close()
+
+
+def release_sftp_client(uri, sftp_client):
+    key = _ssh_key(ssh_transport.parse_uri(uri))
+    with _LOCK:
+        _IDLE_SFTP_CLIENTS.setdefault(key, []).append(sftp_client)
+
+
+def _ftp_key(parsed_uri):
+    return parsed_uri['scheme'], parsed_uri['host'], parsed_uri['user'], parsed_uri['port'], parsed_uri['password']
+
+
+def acquire_ftp_connection(uri):
+    """Takes an idle, logged in connection to the uri's server from the run's pool, or opens a new one."""
+    parsed_uri = ftp_transport.parse_uri(uri)
+    key = _ftp_key(parsed_uri)
+    with _LOCK:
+        idle = _IDLE_FTP_CONNECTIONS.get(key)
+        conn = idle.pop() if idle else None
+    if conn is not None:
+        try:
+            conn.voidcmd('NOOP')
+            return conn
+        except ftplib.all_errors:
+            conn.close()
+    return ftp_transport._connect(parsed_uri['host'], parsed_uri['user'], parsed_uri['port'], parsed_uri['password'],
+                                  parsed_uri['scheme'] == 'ftps', transport_params={})
+
+
+def release_ftp_connection(uri, conn):
+    key = _ftp_key(ftp_transport.parse_uri(uri))
+    with _LOCK:
+        _IDLE_FTP_CONNECTIONS.setdefault(key, []).append(conn)
+
+
+def open_ftp_file(uri):
+    """
+    Opens a binary stream over a pooled FTP connection. The connection goes back to the pool when the
+    stream is closed after the server confirmed the transfer.
+    """
+    uri_path = ftp_transport.parse_uri(uri)['uri_path']
+    conn = acquire_ftp_connection(uri)
+    conn.voidcmd('TYPE I')
+    sock = conn.transfercmd(f'RETR {uri_path}')
+    fobj = sock.makefile('rb')
+
+    def close(self):
+        if self.released:
+            return
+        self.released = True
+        self.orig_close()
+        sock.close()
+        try:
+            conn.voidresp()
+            release_ftp_connection(uri, conn)
+        except ftplib.all_errors:
+            # e.g. the transfer was aborted because the stream was closed before its end
+            conn.close()
+
+    fobj.released = False
+    fobj.orig_close = fobj.close
+    fobj.close = types.MethodType(close, fobj)
+    return fobj
+
+
+def open_sftp_file(uri):
+    """Opens a binary stream over a pooled SFTP channel, which goes back to the pool when the stream is closed."""
+    uri_path = ssh_transport.parse_uri(uri)['uri_path']
+    sftp_client = acquire_sftp_client(uri)
+    try:
+        fobj = sftp_client.open(uri_path, mode='rb')
+    except BaseException:
+        release_sftp_client(uri, sftp_client)
+        raise
+
+    def close(self):
+        if self.released:
+            return
+        self.released = True
+        try:
+            self.orig_close()
+        finally:
+            release_sftp_client(uri, sftp_client)
+
+    fobj.name = uri_path
+    fobj.released = False
+    fobj.orig_close = fobj.close
+    fobj.close = types.MethodType(close, fobj)
+    return fobj
+
+
+def open_binary(uri, keep_http_body=False):
+    """
+    Returns a binary stream for protocols whose smart_open transport opens a new session or download per
+    file, or None when smart_open should open the uri with the transport_params() of the run.
+    """
+    scheme = uri.split('://', 1)[0]
+    if scheme in ssh_transport.SCHEMES:
+        return open_sftp_file(uri)
+    if scheme in ftp_transport.SCHEMES:
+        return open_ftp_file(uri)
+    if scheme in ('http', 'https'):
+        return open_http_file(uri, keep_body=keep_http_body)
+    return None
+
+
+def transport_params(uri):
+    scheme = uri.split('://', 1)[0]
+    if scheme == 's3':
+        parsed_uri = s3_transport.parse_uri(uri)
+        # Credentials in the uri take precedence over the default client
+        if parsed_uri['access_id'] is None:
+            return {'client': get_s3_client()}
+    elif scheme == 'gs':
+        return {'client': get_gcs_client()}
+    elif scheme == 'azure':
+        return {'client': get_azure_client()}
+    return {}